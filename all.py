@@ -1,18 +1,59 @@
 import os
-import re
-import numpy as np
+import sys
+import argparse
+import subprocess
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from urbansim.utils import misc
 
-# run a full package of scenarios
+# run a full package of scenarios - each scenario runs as its own run.py
+# process so the runs are isolated from each other, and up to --workers of
+# them run at the same time.  Run numbers are handed out here before any run
+# starts (rather than by each run.py reading and incrementing the RUNNUM file
+# at the same time) so every scenario gets a distinct run number that we know
+# for the comparison at the end.
 
-for num in [0, 1, 2, 3, 4]:
-    os.system('python run.py -s %d' % num)
+parser = argparse.ArgumentParser(description='Run a package of scenarios.')
 
-with open('RUNNUM', 'r') as f:
-    runnum = f.readline()
+parser.add_argument('-s', '--scenarios', action='store', nargs='+',
+                    default=["0", "1", "2", "3", "4"],
+                    help='scenarios to run')
 
-lastrun = int(runnum)
-lst = [lastrun for i in range(4)]
-lst1 = [-5, -4, -3, -2]
-runs = [d + c for d, c in zip(lst, lst1)]
-os.system('python scripts/compare_output.py "%d" "%d" "%d" "%d"' %
-          (runs[0], runs[1], runs[2], runs[3]))
+parser.add_argument('-w', '--workers', action='store', type=int,
+                    help='number of scenarios to run at the same time ' +
+                    '(defaults to one per scenario, up to the number of ' +
+                    'cores)')
+
+options = parser.parse_args()
+
+workers = options.workers or min(len(options.scenarios), cpu_count())
+
+runs = [(scenario, misc.get_run_number()) for scenario in options.scenarios]
+
+for scenario, run_num in runs:
+    print "Scenario %s will be run %d" % (scenario, run_num)
+
+
+def run_scenario(run):
+    scenario, run_num = run
+    return subprocess.call([sys.executable, "run.py", "-s", scenario,
+                            "--run-number", str(run_num)])
+
+print "Running %d scenarios with %d workers" % (len(runs), workers)
+
+pool = ThreadPool(workers)
+return_codes = pool.map(run_scenario, runs)
+pool.close()
+pool.join()
+
+finished = []
+for (scenario, run_num), return_code in zip(runs, return_codes):
+    status = "finished" if return_code == 0 else \
+        "FAILED with return code %d" % return_code
+    print "Scenario %s (run %d) %s" % (scenario, run_num, status)
+    if return_code == 0:
+        finished.append(run_num)
+
+if len(finished):
+    os.system('python scripts/compare_output.py ' +
+              ' '.join('"%d"' % run_num for run_num in finished))
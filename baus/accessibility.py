@@ -0,0 +1,522 @@
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import yaml
+import orca
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+from urbansim.models import util
+from urbansim.utils import misc
+
+
+# this computes the network aggregations defined in neighborhood_vars.yaml,
+# regional_vars.yaml and price_vars.yaml (the same yaml networks.from_yaml
+# reads).  From one year to the next only a small part of the region sees new
+# buildings or households, so when incremental_accessibility is enabled in
+# the settings, sums, counts and (flat) averages are updated by adding the
+# change at each node whose sources changed to the nodes within the radius
+# of it, instead of aggregating the whole region again.  Aggregations which
+# can't be updated this way (percentiles, medians) are always recomputed
+# with pandana.
+
+# bump this if the way the variables are computed changes, so results
+# cached by older code aren't used
+CACHE_VERSION = 1
+
+# the per-node sources and aggregated values from the last time each
+# variable was computed, keyed by (config name, variable name)
+_STATE = {}
+
+# spread() searches from groups of changed nodes, and splits a group until
+# the distances of its nodes to the nodes near them fit in this many cells
+MAX_SEARCH_CELLS = 2000000
+
+DECAY_WEIGHTS = {
+    "flat": lambda d, radius: np.ones_like(d),
+    "linear": lambda d, radius: 1.0 - d / radius,
+    "exp": lambda d, radius: np.exp(-1 * d / radius),
+    "exponential": lambda d, radius: np.exp(-1 * d / radius)
+}
+
+
+def incremental_settings():
+    return orca.get_injectable("settings").get(
+        "incremental_accessibility", {})
+
+
+def is_incremental(variable):
+    agg = variable.get("aggregation", "sum").lower()
+    decay = variable.get("decay", "linear").lower()
+    if agg in ["sum", "count"]:
+        return decay in DECAY_WEIGHTS
+    # averages are sums divided by counts, which are always flat
+    return agg in ["ave", "average"] and decay == "flat"
+
+
+# a is the dict of arrays from network_cache.network_arrays
+def graph_from_arrays(a):
+    node_ids = pd.Index(a["node_id"])
+    df = pd.DataFrame({
+        "from": node_ids.get_indexer(a["from"]),
+        "to": node_ids.get_indexer(a["to"]),
+        # pandana stores weights as float32, so round them the same way
+        "weight": np.asarray(a["weight"]).astype('float32').astype('float64')
+    })
+    df = df[(df["from"] >= 0) & (df["to"] >= 0)]
+    # scipy ignores edges with zero weight and would sum duplicate edges
+    df["weight"] = df.weight.clip(lower=1e-9)
+    df = df.groupby(["from", "to"]).weight.min().reset_index()
+
+    return csr_matrix(
+        (df.weight.values, (df["from"].values, df["to"].values)),
+        shape=(len(node_ids), len(node_ids)))
+
+
+# the graph to search from a changed node for the nodes whose aggregations
+# include it - pandana aggregates the nodes within radius of each node, so
+# that's a search along the edges in reverse, and two way networks can be
+# searched in either direction (with the shorter edge where both directions
+# are given).  The last node has no edges - _reached connects it to the
+# nodes it searches from.
+def _search_graph(net):
+    graph = getattr(net, "search_graph", None)
+    if graph is not None:
+        return graph
+
+    g = graph_from_arrays(net.graph_arrays).tocoo()
+    rows, cols, weights = [g.col], [g.row], [g.data]
+    if getattr(net, "twoway", True):
+        rows.append(g.row)
+        cols.append(g.col)
+        weights.append(g.data)
+
+    df = pd.DataFrame({"from": np.concatenate(rows),
+                       "to": np.concatenate(cols),
+                       "weight": np.concatenate(weights)})
+    df = df.groupby(["from", "to"]).weight.min().reset_index()
+
+    size = g.shape[0] + 1
+    graph = net.search_graph = csr_matrix(
+        (df.weight.values, (df["from"].values, df["to"].values)),
+        shape=(size, size))
+    return graph
+
+
+# the nodes within radius of any of the sources, found with a single search
+# from the extra node of the search graph, with one way edges to the sources
+def _reached(graph, sources, radius):
+    num_nodes = graph.shape[0] - 1
+    nnz = graph.indptr[-1]
+    g = csr_matrix((
+        # scipy ignores edges with zero weight
+        np.concatenate([graph.data[:nnz], np.repeat(1e-9, len(sources))]),
+        np.concatenate([graph.indices[:nnz], sources]),
+        np.append(graph.indptr[:-1], nnz + len(sources))),
+        shape=graph.shape)
+    d = dijkstra(g, directed=True, indices=num_nodes,
+                 limit=radius + 1e-6)[:num_nodes]
+    return np.flatnonzero(np.isfinite(d))
+
+
+# split the positions of a group of sources into two halves along the
+# longer side of their bounding box, so each half covers less of the region
+def _halves(pos, x, y):
+    x, y = x[pos], y[pos]
+    key = x if np.ptp(x) >= np.ptp(y) else y
+    pos = pos[np.argsort(key, kind="mergesort")]
+    return pos[:len(pos) // 2], pos[len(pos) // 2:]
+
+
+# add amount * decay(distance) from each source node to every node within
+# radius of it - amounts is a list of (amounts, decay) pairs which share the
+# same shortest path searches.  The sources are searched in groups, on the
+# part of the network within radius of the group, so the work and memory
+# depend on the nodes near the sources rather than on the whole network.
+def spread(net, sources, amounts, radius, max_cells=MAX_SEARCH_CELLS):
+    graph = _search_graph(net)
+    x = np.asarray(net.graph_arrays["x"])[sources]
+    y = np.asarray(net.graph_arrays["y"])[sources]
+    out = [np.zeros(graph.shape[0] - 1) for _ in amounts]
+
+    groups = [np.arange(len(sources))]
+    while groups:
+        pos = groups.pop()
+        reached = _reached(graph, sources[pos], radius)
+        if len(pos) > 1 and len(pos) * len(reached) > max_cells:
+            groups.extend(_halves(pos, x, y))
+            continue
+
+        # a shortest path within radius only goes through nodes within
+        # radius, so searching the part of the graph they make up is enough
+        sub = graph[reached][:, reached]
+        d = dijkstra(sub, directed=True, limit=radius,
+                     indices=np.searchsorted(reached, sources[pos]))
+        rows, cols = np.nonzero(np.isfinite(d))
+        d = d[rows, cols]
+
+        for o, (a, decay) in zip(out, amounts):
+            w = a[pos][rows] * DECAY_WEIGHTS[decay](d, radius)
+            o[reached] += np.bincount(cols, weights=w,
+                                      minlength=len(reached))
+
+    return out
+
+
+# the distance from every node to the nearest poi of each category, or
+# max_dist if there's none that close (like pandana's nearest_pois).  Each
+# category gets a virtual node with one way edges to the nodes nearest its
+# pois, and a search from the virtual nodes gives every category's distances
+# in a single call, instead of a nearest poi query from every node for every
+# category.  The edges have to be one way - otherwise a path could go into a
+# virtual node from one poi and out of it at another poi for free.
+#
+# a is the dict of arrays from network_cache.network_arrays and pois maps
+# category names to (x, y) pairs of coordinate arrays
+def nearest_poi_distances(a, pois, max_dist):
+    graph = graph_from_arrays(a).tocoo()
+    num_nodes = graph.shape[0]
+
+    # pandana graphs are two way, so search the network in both directions
+    # (with the shorter edge where both directions are given)
+    rows, cols, weights = [graph.row, graph.col], [graph.col, graph.row], \
+        [graph.data, graph.data]
+    tree = cKDTree(np.column_stack([a["x"], a["y"]]))
+    for i, (x, y) in enumerate(pois.values()):
+        _, nodes = tree.query(np.column_stack([x, y]))
+        nodes = np.unique(nodes)
+        rows.append(np.repeat(num_nodes + i, len(nodes)))
+        cols.append(nodes)
+        # scipy ignores edges with zero weight
+        weights.append(np.repeat(1e-9, len(nodes)))
+
+    df = pd.DataFrame({"from": np.concatenate(rows),
+                       "to": np.concatenate(cols),
+                       "weight": np.concatenate(weights)})
+    df = df.groupby(["from", "to"]).weight.min().reset_index()
+
+    size = num_nodes + len(pois)
+    graph = csr_matrix((df.weight.values,
+                        (df["from"].values, df["to"].values)),
+                       shape=(size, size))
+
+    d = dijkstra(graph, directed=True, limit=max_dist,
+                 indices=np.arange(num_nodes, size))[:, :num_nodes]
+    d[~np.isfinite(d)] = max_dist
+
+    return pd.DataFrame(d.T.astype('float32'),
+                        index=np.asarray(a["node_id"]),
+                        columns=list(pois.keys()))
+
+
+# the sum of the variable and the number of items at each node, which is
+# everything sum, count and average aggregations depend on
+def node_sources(net, df, node_col, vname):
+    df = pd.DataFrame({
+        "node_id": df[node_col],
+        "value": df[vname] if vname else 1.0
+    }).dropna(how="any")
+    grouped = df.groupby("node_id").value
+    return {
+        "sum": grouped.sum().reindex(net.node_ids).fillna(0).values,
+        "count": grouped.size().reindex(net.node_ids).fillna(0).values
+    }
+
+
+# variables which aggregate the same rows of the same table over the same
+# radius with the same decay are computed together - the rows are read and
+# filtered once, pandana is given each variable once, and incremental
+# updates of the whole group share one set of shortest path searches
+def plan(variables):
+    groups = OrderedDict()
+    for variable in variables:
+        key = (variable["dataframe"], tuple(variable.get("filters", [])),
+               variable["radius"], variable.get("decay", "linear").lower())
+        groups.setdefault(key, []).append(variable)
+    return groups
+
+
+def source_frame(dfname, filters, vnames, node_col):
+    flds = [vname for vname in vnames if vname]
+    flds.append(node_col)
+    if filters:
+        flds += util.columns_in_filters(list(filters))
+
+    df = orca.get_table(dfname).to_frame(list(set(flds)))
+
+    if filters:
+        df = util.apply_filter_query(df, list(filters))
+
+    return df
+
+
+def _spec(variable):
+    return (variable.get("aggregation", "sum").lower(),
+            variable.get("decay", "linear").lower(),
+            variable["radius"])
+
+
+# the nodes whose sources changed since the last time the variable was
+# computed, or None if it has to be computed from scratch
+def _changed_nodes(prev, spec, sources, max_changed_nodes, max_updates):
+    if prev is None or prev["spec"] != spec:
+        return None
+
+    if prev["updates"] >= max_updates:
+        print "Updated %d times in a row, recomputing" % prev["updates"]
+        return None
+
+    changed = np.flatnonzero(
+        (sources["sum"] != prev["sources"]["sum"]) |
+        (sources["count"] != prev["sources"]["count"]))
+
+    if len(changed) > max_changed_nodes:
+        print "%d nodes changed, recomputing" % len(changed)
+        return None
+
+    return changed
+
+
+# whether the values are all whole numbers
+def _whole(values):
+    return (np.mod(values, 1) == 0).all()
+
+
+def _result(agg, values):
+    if agg in ["ave", "average"]:
+        s, cnt = values["sum"], values["count"]
+        return np.where(cnt > 0, s / np.maximum(cnt, 1), s)
+    return values[agg]
+
+
+# the raw (before "apply") aggregated values of every variable in a group
+# from plan() - updated from the last time they were computed where possible
+def aggregate_group(net, cfgname, variables, df, node_col, radius, decay):
+    settings = incremental_settings()
+    incremental = settings.get("enabled", False) and \
+        hasattr(net, "graph_arrays")
+
+    results = {}
+    sources = {}
+    updates = []
+    full = []
+
+    for variable in variables:
+        key = (cfgname, variable["name"])
+
+        if not incremental or not is_incremental(variable):
+            _STATE.pop(key, None)
+            full.append(variable)
+            continue
+
+        vname = variable.get("varname", None)
+        if vname not in sources:
+            sources[vname] = node_sources(net, df, node_col, vname)
+
+        prev = _STATE.get(key)
+        changed = _changed_nodes(prev, _spec(variable), sources[vname],
+                                 settings.get("max_changed_nodes", 2000),
+                                 settings.get("max_updates", 5))
+        if changed is None:
+            full.append(variable)
+        else:
+            updates.append((variable, prev, changed))
+
+    if updates:
+        changed = reduce(np.union1d, [u[2] for u in updates])
+        print "Updating %s from %d changed nodes" % \
+            (", ".join(u[0]["name"] for u in updates), len(changed))
+
+        amounts = []
+        for variable, prev, _ in updates:
+            srcs = sources[variable.get("varname", None)]
+            for k in sorted(prev["values"].keys()):
+                delta = srcs[k][changed] - prev["sources"][k][changed]
+                # counts are never decayed
+                amounts.append((delta, "flat" if k == "count" else decay))
+
+        deltas = iter(spread(net, changed, amounts, radius,
+                             settings.get("max_search_cells",
+                                          MAX_SEARCH_CELLS)))
+
+        for variable, prev, _ in updates:
+            srcs = sources[variable.get("varname", None)]
+            values = {}
+            for k in sorted(prev["values"].keys()):
+                values[k] = prev["values"][k] + next(deltas)
+                # counts, and flat sums of whole numbers, are whole numbers,
+                # so round off the error which adding up the changes leaves
+                # and they're the same as computing them again
+                if k == "count" or (decay == "flat" and _whole(srcs[k])):
+                    values[k] = np.round(values[k])
+            _STATE[(cfgname, variable["name"])] = {
+                "spec": _spec(variable),
+                "sources": srcs,
+                "values": values,
+                "updates": prev["updates"] + 1
+            }
+            results[variable["name"]] = _result(_spec(variable)[0], values)
+
+    # sort by the variable so each one only has to be given to pandana once
+    current = []
+    for variable in sorted(full, key=lambda v: v.get("varname", "")):
+        name = variable["name"]
+        agg = variable.get("aggregation", "sum").lower()
+        vname = variable.get("varname", None)
+        print "Computing %s" % name
+
+        if current != [vname]:
+            net.set(df[node_col], variable=df[vname] if vname else None)
+            current = [vname]
+
+        if not incremental or not is_incremental(variable):
+            results[name] = net.aggregate(radius, type=agg,
+                                          decay=decay).values
+            continue
+
+        # keep what we need to update this variable next time
+        aggs = ["sum", "count"] if agg in ["ave", "average"] else [agg]
+        values = {a: net.aggregate(radius, type=a, decay=decay).values
+                  for a in aggs}
+        _STATE[(cfgname, name)] = {
+            "spec": _spec(variable),
+            "sources": sources[vname],
+            "values": values,
+            "updates": 0
+        }
+        results[name] = _result(agg, values)
+
+    return results
+
+
+def cache_dir():
+    return os.path.join(misc.data_dir(), "accessibility_cache")
+
+
+def _hash_values(h, values):
+    values = np.asarray(values)
+    if values.dtype == object:
+        h.update(repr(values.tolist()))
+    else:
+        h.update(np.ascontiguousarray(values).view(np.uint8))
+
+
+# every scenario computes the same accessibility variables in the base year,
+# and scenarios often share inputs in later years as well - so results are
+# stored under a hash of the network, the variable definitions and the rows
+# being aggregated, and any run with the same inputs reads them back
+def cache_key(net, cfg, frames):
+    network_key = getattr(net, "cache_key", None)
+    if network_key is None:
+        return None
+
+    h = hashlib.md5()
+    h.update("version %d network %s\n" % (CACHE_VERSION, network_key))
+    h.update(yaml.dump(cfg))
+    for key in sorted(frames.keys()):
+        df = frames[key]
+        h.update(repr(key))
+        _hash_values(h, df.index.values)
+        for col in sorted(df.columns):
+            h.update(col)
+            _hash_values(h, df[col].values)
+    return h.hexdigest()
+
+
+def _read_cache(key):
+    fname = os.path.join(cache_dir(), key + ".h5")
+    if not os.path.exists(fname):
+        return None
+    nodes = pd.read_hdf(fname, "nodes")
+    # the modification time is when the file was last used, so the files
+    # which are removed to keep the cache small are the least recently used
+    os.utime(fname, None)
+    return nodes
+
+
+# remove the least recently used files until the cache is at most max_mb
+def _trim_cache(max_mb):
+    files = []
+    for fname in os.listdir(cache_dir()):
+        if fname.endswith(".h5"):
+            st = os.stat(os.path.join(cache_dir(), fname))
+            files.append((st.st_mtime, st.st_size, fname))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, fname in sorted(files):
+        if total <= max_mb * 1024 * 1024:
+            break
+        try:
+            os.remove(os.path.join(cache_dir(), fname))
+        except OSError:
+            # another run removed it first
+            pass
+        total -= size
+
+
+def _write_cache(key, nodes, max_mb):
+    if not os.path.exists(cache_dir()):
+        os.makedirs(cache_dir())
+    fname = os.path.join(cache_dir(), key + ".h5")
+    # write to a temp file first so a run reading the cache never sees a
+    # partly written file
+    tmp_fname = fname + ".%d.tmp" % os.getpid()
+    nodes.to_hdf(tmp_fname, "nodes", mode="w")
+    os.rename(tmp_fname, fname)
+    _trim_cache(max_mb)
+
+
+# works like urbansim's networks.from_yaml
+def from_yaml(net, cfgname):
+    print "Computing accessibility variables"
+    cfg = yaml.load(open(misc.config(cfgname)))
+
+    assert "node_col" in cfg, "Need to specify from where to take the node id"
+    node_col = cfg.get('node_col')
+
+    variables = cfg['variable_definitions']
+    groups = plan(variables)
+
+    # groups which differ only in radius or decay share the same rows
+    frames = {}
+    for dfname, filters, _, _ in groups.keys():
+        if (dfname, filters) not in frames:
+            vnames = [v.get("varname", None) for v in variables
+                      if v["dataframe"] == dfname and
+                      tuple(v.get("filters", [])) == filters]
+            frames[(dfname, filters)] = \
+                source_frame(dfname, filters, vnames, node_col)
+
+    settings = orca.get_injectable("settings")
+    key = None
+    if settings.get("accessibility_cache", False):
+        key = cache_key(net, cfg, frames)
+        nodes = _read_cache(key) if key else None
+        if nodes is not None:
+            print "Read accessibility variables from cache %s" % key
+            # the incremental updates start over from the next year on
+            for variable in variables:
+                _STATE.pop((cfgname, variable["name"]), None)
+            return nodes
+
+    results = {}
+    for (dfname, filters, radius, decay), group in groups.items():
+        results.update(aggregate_group(
+            net, cfgname, group, frames[(dfname, filters)], node_col,
+            radius, decay))
+
+    nodes = pd.DataFrame(results, index=net.node_ids,
+                         columns=[v["name"] for v in variables])
+
+    for variable in variables:
+        if "apply" in variable:
+            name = variable["name"]
+            nodes[name] = nodes[name].apply(eval(variable["apply"]))
+
+    if key:
+        _write_cache(key, nodes, settings.get("accessibility_cache_max_mb",
+                                              1000))
+
+    return nodes
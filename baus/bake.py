@@ -0,0 +1,120 @@
+import os
+import hashlib
+import pandas as pd
+import orca
+from urbansim.utils import misc
+
+
+# building the base year buildings, households and jobs tables takes minutes
+# (manual edits, deed restricted unit sampling, household overrides, the
+# portola valley job move, and correct_baseyear_data) even though the result
+# only changes when the inputs do.  "python run.py --bake" does all of that
+# once and writes the finished tables to a snapshot, and the datasources
+# read the snapshot instead as long as the inputs haven't changed.
+
+# bump this whenever the code which builds the base year tables changes in
+# a way the input hashes below can't see (e.g. in urbansim_defaults)
+SNAPSHOT_VERSION = 1
+
+BAKED_TABLES = ["buildings", "households", "jobs"]
+
+# set to False to always build the tables from scratch
+USE_SNAPSHOT = True
+
+# names of the tables which were read from the snapshot in this run
+LOADED = set()
+
+_key = []
+
+
+def snapshot_path():
+    return os.path.join(misc.data_dir(), "baseyear_snapshot.h5")
+
+
+def _file_md5(fname):
+    h = hashlib.md5()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# the files the snapshot is built from, including the code which shapes the
+# base year tables - datasources.py, correct_baseyear_data in models.py and
+# the sampling and utils helpers they use
+def snapshot_inputs():
+    return [
+        misc.config("settings.yaml"),
+        os.path.join(misc.data_dir(), "manual_edits.csv"),
+        os.path.join("data", "household_building_id_overrides.csv"),
+        os.path.join("data", "deed_restricted_zone_totals.csv"),
+        os.path.join("data", "baseyear_taz_controls.csv")
+    ] + [
+        os.path.join(os.path.dirname(__file__), fname)
+        for fname in ["datasources.py", "models.py", "sampling.py",
+                      "utils.py"]
+    ]
+
+
+# the key which identifies the inputs the snapshot was built from - the h5
+# store is several gigabytes so it's identified by its size and modification
+# time rather than by hashing its contents
+def snapshot_key():
+    if _key:
+        return _key[0]
+
+    settings = orca.get_injectable("settings")
+    store = os.stat(os.path.join(misc.data_dir(), settings["store"]))
+
+    h = hashlib.md5()
+    h.update("version %d\n" % SNAPSHOT_VERSION)
+    h.update("%s %d %d\n" % (settings["store"], store.st_size,
+                             int(store.st_mtime)))
+    for fname in snapshot_inputs():
+        h.update("%s %s\n" % (os.path.basename(fname), _file_md5(fname)))
+
+    _key.append(h.hexdigest())
+    return _key[0]
+
+
+# returns the baked version of the table, or None if there's no snapshot or
+# the snapshot was built from different inputs
+def load_snapshot(name):
+    fname = snapshot_path()
+    if not USE_SNAPSHOT or not os.path.exists(fname):
+        return None
+
+    store = pd.HDFStore(fname, "r")
+    try:
+        if "key" not in store or store["key"].iloc[0] != snapshot_key():
+            print "Base year snapshot is out of date, building %s from " \
+                "scratch - run 'python run.py --bake' to update it" % name
+            return None
+        df = store[name]
+    finally:
+        store.close()
+
+    print "Read %s from base year snapshot" % name
+    LOADED.add(name)
+    return df
+
+
+@orca.step()
+def bake_baseyear():
+    fname = snapshot_path()
+
+    # write to a temp file first so a crash while writing doesn't leave a
+    # snapshot behind which looks valid
+    tmp_fname = fname + ".tmp"
+    if os.path.exists(tmp_fname):
+        os.remove(tmp_fname)
+
+    store = pd.HDFStore(tmp_fname, "w")
+    for name in BAKED_TABLES:
+        store[name] = orca.get_table(name).local
+    store["key"] = pd.Series([snapshot_key()])
+    store.close()
+
+    os.rename(tmp_fname, fname)
+
+    print "Wrote base year snapshot to %s" % fname
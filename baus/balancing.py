@@ -0,0 +1,180 @@
+import numpy as np
+
+
+#####################
+# BALANCING
+#####################
+
+
+def _marginal(seed, axes):
+    # sum seed over every axis which isn't in axes, keeping the summed axes
+    # around (with length 1) so the result broadcasts against seed
+    other = tuple(i for i in range(seed.ndim) if i not in axes)
+    return seed.sum(axis=other, keepdims=True)
+
+
+def _residual(seed, marginals):
+    return max(np.absolute(target - _marginal(seed, axes)).sum()
+               for axes, target in marginals)
+
+
+def ipf(seed, marginals, tolerance=1, max_iterations=50):
+    """
+    Iterative proportional fitting (raking) of seed to a set of marginal
+    totals, done in place.
+
+    Each marginal is an (axes, target) pair, where axes are the axes of
+    seed the target is given over and target has the shape of seed along
+    those axes, e.g. for a (zones x ages) matrix the row totals are
+    ((0,), zone_totals) and the column totals are ((1,), age_totals).  To
+    balance a stack of matrices in one call, include the stack axis in
+    every marginal, e.g. for a (zones x incomes x ages) array where every
+    zone is balanced separately, ((0, 1), zone_income_totals) and
+    ((0, 2), zone_age_totals).
+
+    Parameters
+    ----------
+    seed : ndarray of floats
+        The best guess at the cell values - this is scaled in place
+    marginals : list of (tuple, ndarray)
+        The axes and target totals to match
+    tolerance : float, optional
+        Stop as soon as the total absolute difference between every
+        target and the current marginal is less than this
+    max_iterations : int, optional
+        The maximum number of passes over all the marginals
+
+    Returns
+    -------
+    seed : ndarray
+        The balanced seed (the same array which was passed in)
+    residuals : ndarray
+        The largest total absolute difference from any target after each
+        pass, so convergence can be checked
+    """
+    marginals = [
+        (tuple(sorted(axes)),
+         np.asarray(target, dtype="float64").reshape(
+             [seed.shape[i] if i in axes else 1 for i in range(seed.ndim)]))
+        for axes, target in marginals
+    ]
+
+    residuals = []
+    for _ in range(max_iterations):
+        for axes, target in marginals:
+            current = _marginal(seed, axes)
+            # cells which sum to zero can't be scaled to anything else, and
+            # a zero target zeroes its cells
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ratio = np.where(current > 0, target / current, 0)
+            np.multiply(seed, ratio, out=seed)
+
+            residual = _residual(seed, marginals)
+            if residual < tolerance:
+                residuals.append(residual)
+                return seed, np.array(residuals)
+
+        residuals.append(residual)
+
+    return seed, np.array(residuals)
+
+
+#####################
+# INTEGERIZING
+#####################
+
+
+# systematic sampling of the fractional parts of each row - one uniform per
+# row places k evenly spaced points along the row's cumulative fractional
+# parts (which add up to k), and each cell the points land in is rounded up
+def _round_rows(mat, row_totals, rng):
+    floor = np.floor(mat)
+    remainder = mat - floor
+    k = row_totals - floor.sum(axis=1)
+
+    cumulative = np.cumsum(remainder, axis=1)
+    # get rid of floating point error so exactly k points fit in each row
+    cumulative[:, -1] = k
+    u = 1.0 - rng.random_sample(len(mat))[:, np.newaxis]  # in (0, 1]
+    points = np.floor(cumulative - u + 1)
+    round_up = np.diff(np.hstack([np.zeros((len(mat), 1)), points]), axis=1)
+
+    return (floor + round_up).astype("int64")
+
+
+# move single units between cells of the same row (so row totals are kept)
+# from columns with too many units to columns with too few, picking the rows
+# where the move takes the cells closest to their unrounded values
+def _match_columns(result, mat, col_totals):
+    diff = result.sum(axis=0) - col_totals
+    while (diff > 0).any():
+        over = np.argmax(diff)
+        under = np.argmin(diff)
+
+        score = (result[:, over] - mat[:, over]) + \
+            (mat[:, under] - result[:, under])
+        score[result[:, over] <= 0] = -np.inf
+        candidates = np.flatnonzero(score > -np.inf)
+        if len(candidates) == 0:
+            raise ValueError("Can't match column totals without changing "
+                             "row totals")
+
+        n = min(diff[over], -diff[under], len(candidates))
+        rows = candidates[np.argsort(-score[candidates], kind="mergesort")[:n]]
+        result[rows, over] -= 1
+        result[rows, under] += 1
+        diff[over] -= n
+        diff[under] += n
+
+    return result
+
+
+def integerize(mat, row_totals, col_totals=None, rng=None):
+    """
+    Round a (rows x categories) matrix of floats to integers so that every
+    row adds up to its (integer) total, and optionally every column to its
+    total as well.  Each row is first scaled to its total, and then cells
+    are rounded up or down at random with probability given by their
+    fractional part, so the expected value of every cell is its scaled
+    value.
+
+    Parameters
+    ----------
+    mat : ndarray or DataFrame
+        The values to round, e.g. zones x age categories - NaNs are zeros
+    row_totals : array-like
+        The integer total for every row - rows which have a total but no
+        values to scale to it are left as zeros
+    col_totals : array-like, optional
+        The integer total for every column, which has to add up to the
+        same total as row_totals
+    rng : RandomState, optional
+        Random number generator, defaults to the global numpy one
+
+    Returns
+    -------
+    result : ndarray of ints
+        The rounded matrix
+    """
+    rng = np.random if rng is None else rng
+
+    mat = np.nan_to_num(np.asarray(mat, dtype="float64"))
+    row_totals = np.asarray(row_totals).round().astype("int64")
+
+    row_sums = mat.sum(axis=1)
+    empty = row_sums <= 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mat = mat * np.where(empty, 0, row_totals / row_sums)[:, np.newaxis]
+    row_totals = np.where(empty, 0, row_totals)
+
+    result = _round_rows(mat, row_totals, rng)
+
+    if col_totals is not None:
+        col_totals = np.asarray(col_totals).round().astype("int64")
+        if col_totals.sum() != row_totals.sum():
+            raise ValueError("Column totals add up to %d but row totals add "
+                             "up to %d" % (col_totals.sum(),
+                                           row_totals.sum()))
+        result = _match_columns(result, mat, col_totals)
+
+    return result
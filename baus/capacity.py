@@ -0,0 +1,208 @@
+import os
+import glob
+import re
+import numpy as np
+import pandas as pd
+import orca
+from urbansim.utils import misc
+# these register the tables and parcel columns - nothing is computed until
+# it's asked for
+import datasources
+import variables
+import bake
+from zoning import GROSS_AVE_UNIT_SIZE
+
+
+# Zoned capacity used to be computed by importing all of the models and
+# pulling zoned_du_underbuild_nodev through orca, one scenario per run.
+# This only registers the datasources and variables, reads the parcels,
+# buildings, zoning and parcels_geography tables, and computes the capacity
+# of the baseline and every zoning_mods file at once with the zoning overlay
+# (the buildings come from the base year snapshot when there is one, see
+# bake.py, and otherwise straight from the store - see capacity_buildings).
+# The formulas are the ones behind the zoned_du, zoned_du_underbuild and
+# zoned_du_underbuild_nodev parcel columns.
+
+CAPACITY_COLUMNS = ["zoned_du", "zoned_du_underbuild",
+                    "zoned_du_underbuild_nodev"]
+
+
+# the baseline and every scenario with a zoning_mods file in the data dir
+def all_scenarios():
+    scenarios = []
+    for fname in glob.glob(os.path.join(misc.data_dir(),
+                                        "zoning_mods_*.csv")):
+        m = re.match("zoning_mods_(.+)\.csv$", os.path.basename(fname))
+        scenarios.append(m.group(1))
+    return ["baseline"] + sorted(scenarios)
+
+
+# the existing development on every parcel which the underbuild capacity is
+# measured against
+def parcel_development(parcels, buildings, settings):
+    df = pd.DataFrame(index=parcels.index)
+    df["geom_id"] = parcels.geom_id
+    df["parcel_size"] = parcels.shape_area * \
+        settings.get("parcel_size_factor", 1)
+    df["parcel_acres"] = df.parcel_size / 43560.0
+
+    grouped = buildings.groupby("parcel_id")
+    df["total_residential_units"] = grouped.residential_units.sum().\
+        reindex(df.index).fillna(0)
+    df["total_non_residential_sqft"] = grouped.non_residential_sqft.sum().\
+        reindex(df.index).fillna(0)
+    df["oldest_building"] = grouped.year_built.min().\
+        reindex(df.index).fillna(9999)
+
+    # see the parcel_rules column
+    df["parcel_rules"] = (~(
+        (df.oldest_building < 1940) |
+        ((df.total_residential_units == 1) & (df.parcel_acres < .5)) |
+        (df.parcel_size < 2000))).astype('int')
+
+    return df
+
+
+# the columns of the base year buildings which capacity needs.  The orca
+# buildings table is built from the households and jobs (and so runs the job
+# allocation), so without a snapshot these are read from the store, with the
+# manual edits and clean up the buildings table does to them - except the
+# non-residential sqft isn't raised to fit the jobs
+def capacity_buildings(settings):
+    cols = ["parcel_id", "residential_units", "non_residential_sqft",
+            "year_built"]
+
+    df = bake.load_snapshot("buildings")
+    if df is not None:
+        return df[cols]
+
+    store = orca.get_injectable("store")
+    df = store['buildings'][cols + ["building_type_id"]]
+    # the table_reprocess settings drop buildings without a type
+    df = df[df.building_type_id.notnull()]
+
+    if settings.get("reconcile_residential_units_and_households", False):
+        # prevent overfull buildings (residential)
+        df["residential_units"] = pd.concat(
+            [df.residential_units,
+             store['households'].building_id.value_counts()],
+            axis=1).max(axis=1).reindex(df.index)
+
+    edits = orca.get_table("manual_edits").local
+    edits = edits[(edits.table == 'buildings') &
+                  edits.attribute.isin(df.columns) &
+                  edits.id.isin(df.index)]
+    for index, row, col, val in \
+            edits[["id", "attribute", "new_value"]].itertuples():
+        df.set_value(row, col, val)
+
+    df["residential_units"] = df.residential_units.fillna(0)
+    # keeps parking lots from getting redeveloped
+    df.loc[df.building_type_id.isin([15, 16]), "non_residential_sqft"] = 0
+
+    return df[cols]
+
+
+def parcel_capacity(development, max_dua, scenarios):
+    """
+    The zoned residential capacity of every parcel in each of the scenarios.
+
+    Parameters
+    ----------
+    development : DataFrame
+        The existing development on each parcel (see parcel_development)
+    max_dua : DataFrame
+        The effective max dua of every parcel, with a column for each
+        scenario (see ZoningOverlay.effective_max_dua)
+    scenarios : list of str
+        The scenarios to compute
+
+    Returns
+    -------
+    df : DataFrame
+        The columns of development and a CAPACITY_COLUMNS_<scenario> column
+        for every scenario
+    """
+    df = development.copy()
+
+    dua = max_dua[scenarios].values
+    units = development.total_residential_units.values[:, np.newaxis]
+
+    zoned_du = dua * development.parcel_acres.values[:, np.newaxis]
+
+    # subtract from zoned du, the total res units, but also the equivalent
+    # of non-res sqft in res units
+    with np.errstate(invalid="ignore", divide="ignore"):
+        underbuild = np.clip(
+            zoned_du - units -
+            development.total_non_residential_sqft.values[:, np.newaxis] /
+            GROSS_AVE_UNIT_SIZE, 0, None)
+        ratio = underbuild / units
+    ratio[np.isposinf(ratio)] = 1
+    # only count parcels where the additional units are at least half the
+    # existing units
+    underbuild = np.where(ratio > .5, underbuild, 0).astype('int')
+
+    nodev = underbuild * development.parcel_rules.values[:, np.newaxis]
+
+    for k, scenario in enumerate(scenarios):
+        df["zoned_du_%s" % scenario] = zoned_du[:, k]
+        df["zoned_du_underbuild_%s" % scenario] = underbuild[:, k]
+        df["zoned_du_underbuild_nodev_%s" % scenario] = nodev[:, k]
+
+    return df
+
+
+def capacity_by(df, col, scenarios):
+    cols = ["total_residential_units"] + \
+        ["%s_%s" % (c, scenario)
+         for scenario in scenarios for c in CAPACITY_COLUMNS]
+    return df.groupby(col)[cols].sum()
+
+
+def zoning_capacity(scenarios=None):
+    """
+    Compute the zoned capacity of the scenarios (the baseline and every
+    zoning_mods file by default) by parcel, jurisdiction and pda.
+
+    Returns
+    -------
+    parcels, juris, pda : DataFrames
+        The capacity of each scenario (see parcel_capacity) by parcel, and
+        summed by jurisdiction and pda
+    """
+    scenarios = scenarios or all_scenarios()
+    settings = orca.get_injectable("settings")
+
+    parcels = orca.get_table("parcels").to_frame(["geom_id", "shape_area"])
+    buildings = capacity_buildings(settings)
+    parcels_geography = orca.get_table("parcels_geography").to_frame(
+        ["juris_name", "jurisdiction_id", "pda_id"]).reindex(parcels.index)
+
+    zoning_overlay = orca.get_injectable("zoning_overlay")
+    max_dua = zoning_overlay.effective_max_dua(scenarios)
+
+    df = parcel_capacity(parcel_development(parcels, buildings, settings),
+                         max_dua, scenarios)
+    df["juris_name"] = parcels_geography.juris_name
+    df["juris_id"] = parcels_geography.jurisdiction_id
+    df["pda_id"] = parcels_geography.pda_id
+
+    return df, capacity_by(df, ["juris_name", "juris_id"], scenarios), \
+        capacity_by(df, "pda_id", scenarios)
+
+
+# writes the parcel, juris and pda capacity to one compressed h5 file with
+# the keys "parcels", "juris" and "pda"
+def write_zoning_capacity(fname, scenarios=None):
+    scenarios = scenarios or all_scenarios()
+    parcels, juris, pda = zoning_capacity(scenarios)
+
+    store = pd.HDFStore(fname, "w", complevel=9, complib="zlib")
+    store.put("parcels", parcels, format="table")
+    store.put("juris", juris.reset_index(), format="table")
+    store.put("pda", pda.reset_index(), format="table")
+    store.close()
+
+    print "Wrote zoned capacity for scenarios %s to %s" % \
+        (", ".join(scenarios), fname)
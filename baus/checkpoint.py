@@ -0,0 +1,96 @@
+import os
+import glob
+import re
+import cPickle
+import numpy as np
+import orca
+
+
+# these are the tables which the simulation modifies from year to year -
+# everything else is either static input data or is recomputed from these
+CHECKPOINT_TABLES = ["buildings", "households", "jobs"]
+
+
+def checkpoint_path(run_number, year):
+    return os.path.join("runs", "run%d_checkpoint_%d.pkl" % (run_number, year))
+
+
+# return the run number of the most recent run which saved a checkpoint
+# for the given year
+def latest_checkpoint_run(year):
+    runs = []
+    for fname in glob.glob(os.path.join("runs", "run*_checkpoint_%d.pkl" %
+                                        year)):
+        m = re.match(r"run(\d+)_checkpoint_", os.path.basename(fname))
+        if m:
+            runs.append(int(m.group(1)))
+
+    if len(runs) == 0:
+        raise IOError("No checkpoint found for year %d" % year)
+
+    return max(runs)
+
+
+def save_checkpoint(fname, year):
+    summary = orca.get_injectable("summary")
+
+    base_year_measures = None
+    if "base_year_measures" in orca.list_injectables():
+        base_year_measures = orca.get_injectable("base_year_measures")
+
+    d = {
+        "year": year,
+        "scenario": orca.get_injectable("scenario"),
+        "tables": {name: orca.get_table(name).local
+                   for name in CHECKPOINT_TABLES},
+        "coffer": orca.get_injectable("coffer"),
+        "parcel_output": summary.parcel_output,
+        "zone_output": getattr(summary, "zone_output", None),
+        "base_year_measures": base_year_measures,
+        # so a resumed run draws the same random numbers as the original
+        "random_state": np.random.get_state()
+    }
+
+    # write to a temp file first so a crash while writing doesn't leave a
+    # truncated checkpoint behind
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, "wb") as f:
+        cPickle.dump(d, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_fname, fname)
+
+
+# restores the state saved by save_checkpoint and returns the year the
+# checkpoint was saved after
+def restore_checkpoint(fname):
+    with open(fname, "rb") as f:
+        d = cPickle.load(f)
+
+    scenario = orca.get_injectable("scenario")
+    if d["scenario"] != scenario:
+        print "WARNING: checkpoint was saved for scenario %s " \
+            "but running scenario %s" % (d["scenario"], scenario)
+
+    for name, df in d["tables"].items():
+        orca.add_table(name, df)
+
+    orca.add_injectable("coffer", d["coffer"])
+
+    summary = orca.get_injectable("summary")
+    summary.parcel_output = d["parcel_output"]
+    summary.zone_output = d["zone_output"]
+
+    if d["base_year_measures"] is not None:
+        orca.add_injectable("base_year_measures", d["base_year_measures"])
+
+    np.random.set_state(d["random_state"])
+
+    print "Restored checkpoint for year %d from %s" % (d["year"], fname)
+
+    return d["year"]
+
+
+@orca.step("save_checkpoint")
+def save_checkpoint_step(run_number, year):
+    fname = checkpoint_path(run_number, year)
+    save_checkpoint(fname, year)
+    print "Saved checkpoint for year %d to %s" % (year, fname)
@@ -7,6 +7,9 @@ from urbansim.utils import misc
 import orca
 from utils import geom_id_to_parcel_id, parcel_id_to_geom_id
 from utils import nearest_neighbor
+import bake
+import sampling
+import zoning
 
 
 #####################
@@ -109,14 +112,21 @@ def landmarks():
 
 
 @orca.table('jobs', cache=True)
-def jobs(store, parcels):
+def jobs(store, parcels, baseyear_taz_controls):
 
-    if 'jobs_urbansim_allocated' not in store:
-        # if jobs allocation hasn't been done, then do it
-        # (this should only happen once)
-        orca.run(["allocate_jobs"])
+    df = bake.load_snapshot("jobs")
+    if df is not None:
+        return df
+
+    jobs_df = store['jobs_urbansim_allocated'] \
+        if 'jobs_urbansim_allocated' in store else None
 
-    jobs_df = store['jobs_urbansim_allocated']
+    if jobs_df is None or not job_allocation_matches_controls(
+            jobs_df, baseyear_taz_controls.local):
+        # if jobs allocation hasn't been done, or the controls have changed
+        # since it was done, then do it
+        orca.run(["allocate_jobs"])
+        jobs_df = store['jobs_urbansim_allocated']
 
     # grab it from store in order to avoid circular reference - if you
     # use the orca buildings table it depends on jobs so in jobs we can't
@@ -147,68 +157,84 @@ def jobs(store, parcels):
     return jobs_df
 
 
-# the way this works is there is an orca step to do jobs allocation, which
-# reads base year totals and creates jobs and allocates them to buildings,
-# and writes it back to the h5.  then the actual jobs table above just reads
-# the auto-allocated version from the h5.  was hoping to just do allocation
-# on the fly but it takes about 4 minutes so way to long to do on the fly
-@orca.step('allocate_jobs')
-def jobs(store, baseyear_taz_controls, settings, parcels):
-
-    # this isn't pretty, but can't use orca table because there would
-    # be a circular dependenct - I mean jobs dependent on buildings and
-    # buildings on jobs, so we have to grab from the store directly
-    buildings = store['buildings']
-    buildings["non_residential_sqft"][
-        buildings.building_type_id.isin([15, 16])] = 0
-    buildings["building_sqft"][buildings.building_type_id.isin([15, 16])] = 0
-    buildings["zone_id"] = misc.reindex(parcels.zone_id, buildings.parcel_id)
+# returns a dataframe with one row per taz and one column per sector id
+# with the number of jobs in the base year controls
+def job_controls_by_sector(controls):
+    sector_cols = [c for c in controls.columns if c.startswith("emp_sec")]
+    df = controls[sector_cols].fillna(0).astype('int')
+    # get integer sector ids
+    df.columns = [int(''.join(c for c in col if c.isdigit()))
+                  for col in sector_cols]
+    return df
 
-    # we need to do a new assignment from the controls to the buildings
 
-    # first disaggregate the job totals
-    sector_map = settings["naics_to_empsix"]
-    jobs = []
-    for taz, row in baseyear_taz_controls.local.iterrows():
-        for sector_col, num in row.iteritems():
+def job_allocation_matches_controls(jobs_df, controls):
+    expected = job_controls_by_sector(controls)
+    actual = jobs_df.groupby(["taz", "sector_id"]).size().unstack().\
+        reindex(index=expected.index, columns=expected.columns).fillna(0)
+    return len(jobs_df) == expected.values.sum() and \
+        (actual.values == expected.values).all()
 
-            # not a sector total
-            if not sector_col.startswith("emp_sec"):
-                continue
 
-            # get integer sector id
-            sector_id = int(''.join(c for c in sector_col if c.isdigit()))
-            sector_name = sector_map[sector_id]
+# disaggregates the job totals by taz and sector in controls to individual
+# jobs and assigns each job to a building in its taz, with probability
+# proportional to non-residential sqft (or to building sqft in tazs which
+# have no non-residential buildings)
+def allocate_jobs_to_buildings(controls, buildings, sector_map, rng=None):
 
-            jobs += [[sector_id, sector_name, taz, -1]] * num
+    counts = job_controls_by_sector(controls)
+    num_tazs, num_sectors = counts.shape
+    flat_counts = counts.values.ravel()
 
-    # df is now the
-    df = pd.DataFrame(jobs, columns=[
-        'sector_id', 'empsix', 'taz', 'building_id'])
+    # one row per job, ordered by taz and then sector
+    sector_ids = np.repeat(np.tile(counts.columns.values, num_tazs),
+                           flat_counts)
+    df = pd.DataFrame({
+        'sector_id': sector_ids,
+        'empsix': pd.Series(sector_ids).map(sector_map).values,
+        'taz': np.repeat(np.repeat(counts.index.values, num_sectors),
+                         flat_counts),
+    }, columns=['sector_id', 'empsix', 'taz', 'building_id'])
 
     # just do random assignment weighted by job spaces - we'll then
     # fill in the job_spaces if overfilled in the next step (code
     # has existed in urbansim for a while)
-    for taz, cnt in df.groupby('taz').size().iteritems():
+    non_residential_sqft = buildings.non_residential_sqft.fillna(0)
+    has_non_res = buildings.zone_id[non_residential_sqft > 0].unique()
+    # if no non-res buildings, put jobs in res buildings
+    weights = np.where(
+        buildings.zone_id.isin(has_non_res),
+        non_residential_sqft.clip(lower=0),
+        buildings.building_sqft.fillna(0).clip(lower=0))
 
-        potential_add_locations = buildings.non_residential_sqft[
-            (buildings.zone_id == taz) &
-            (buildings.non_residential_sqft > 0)]
+    draws = sampling.grouped_weighted_sample(
+        buildings.zone_id.values, weights, counts.sum(axis=1), rng=rng)
 
-        if len(potential_add_locations) == 0:
-            # if no non-res buildings, put jobs in res buildings
-            potential_add_locations = buildings.building_sqft[
-                buildings.zone_id == taz]
+    # draws come back grouped by taz in the same order as the jobs
+    df["building_id"] = buildings.index.values[draws]
 
-        weights = potential_add_locations / potential_add_locations.sum()
+    return df
 
-        print taz, len(potential_add_locations),\
-            potential_add_locations.sum(), cnt
 
-        buildings_ids = potential_add_locations.sample(
-            cnt, replace=True, weights=weights)
+# the way this works is there is an orca step to do jobs allocation, which
+# reads base year totals and creates jobs and allocates them to buildings,
+# and writes it back to the h5.  then the actual jobs table above just reads
+# the auto-allocated version from the h5, and reruns the allocation whenever
+# the base year controls no longer match it (it only takes a few seconds)
+@orca.step('allocate_jobs')
+def allocate_jobs(store, baseyear_taz_controls, settings, parcels):
+
+    # this isn't pretty, but can't use orca table because there would
+    # be a circular dependenct - I mean jobs dependent on buildings and
+    # buildings on jobs, so we have to grab from the store directly
+    buildings = store['buildings']
+    buildings.loc[buildings.building_type_id.isin([15, 16]),
+                  ["non_residential_sqft", "building_sqft"]] = 0
+    buildings["zone_id"] = misc.reindex(parcels.zone_id, buildings.parcel_id)
 
-        df["building_id"][df.taz == taz] = buildings_ids.index.values
+    # we need to do a new assignment from the controls to the buildings
+    df = allocate_jobs_to_buildings(baseyear_taz_controls.local, buildings,
+                                    settings["naics_to_empsix"])
 
     s = buildings.zone_id.loc[df.building_id].value_counts()
     t = baseyear_taz_controls.emp_tot - s
@@ -248,6 +274,18 @@ def jobs(store, baseyear_taz_controls, settings, parcels):
     store['jobs_urbansim_allocated'] = df
 
 
+# distances from the travel model nodes to the regional landmarks - these are
+# written by the poi_distances step, and read from the older csv if it hasn't
+# been run
+@orca.table(cache=True)
+def regional_poi_distances(settings):
+    fname = settings["poi_distances"]["regional"]["output"]
+    if os.path.exists(fname):
+        return pd.read_hdf(fname, "poi_distances")
+    return pd.read_csv(os.path.join("data", "regional_poi_distances.csv"),
+                       index_col="tmnode_id")
+
+
 @orca.table(cache=True)
 def baseyear_taz_controls():
     return pd.read_csv(os.path.join("data",
@@ -336,6 +374,17 @@ def zoning_baseline(parcels, zoning_lookup, settings):
     return df
 
 
+# the baseline zoning with every scenario's zoning_mods as a sparse layer of
+# overrides, see zoning.py
+@orca.injectable('zoning_overlay', cache=True)
+def zoning_overlay(parcels, parcels_geography, zoning_baseline, settings):
+    return zoning.ZoningOverlay(parcels.index,
+                                parcels_geography.zoningmodcat,
+                                zoning_baseline.to_frame(),
+                                parcels.juris,
+                                settings)
+
+
 @orca.table('zoning_scenario', cache=True)
 def zoning_scenario(parcels_geography, scenario, settings):
 
@@ -525,6 +574,11 @@ def development_projects(parcels, settings, scenario):
 
 @orca.table('households', cache=True)
 def households(store, settings, parcels_geography):
+
+    df = bake.load_snapshot("households")
+    if df is not None:
+        return df
+
     # start with households from urbansim_defaults
     df = datasources.households(store, settings)
 
@@ -558,6 +612,10 @@ def households(store, settings, parcels_geography):
 def buildings(store, parcels, households, jobs, building_sqft_per_job,
               settings, manual_edits):
 
+    df = bake.load_snapshot("buildings")
+    if df is not None:
+        return df
+
     # start with buildings from urbansim_defaults
     df = datasources.buildings(store, households, jobs,
                                building_sqft_per_job, settings)
@@ -603,28 +661,22 @@ def buildings(store, parcels, households, jobs, building_sqft_per_job,
         reindex(df.index).fillna(-1)
 
     # sample deed restricted units to match current deed restricted unit
-    # zone totals
-    for taz, row in pd.read_csv('data/deed_restricted_zone_totals.csv',
-                                index_col='taz_key').iterrows():
-
-        cnt = row["units"]
-
-        if cnt <= 0:
-            continue
-
-        potential_add_locations = df.residential_units[
-            (zone_ids == taz) &
-            (df.residential_units > 0)]
-
-        assert len(potential_add_locations) > 0
-
-        weights = potential_add_locations / potential_add_locations.sum()
-
-        buildings_ids = potential_add_locations.sample(
-            cnt, replace=True, weights=weights)
-
-        units = pd.Series(buildings_ids.index.values).value_counts()
-        df.loc[units.index, "deed_restricted_units"] += units.values
+    # zone totals - units are placed in buildings with probability
+    # proportional to the number of residential units
+    zone_totals = pd.read_csv('data/deed_restricted_zone_totals.csv',
+                              index_col='taz_key').units.astype('int')
+
+    potential_add_locations = df.residential_units[
+        df.residential_units > 0]
+
+    draws = sampling.grouped_weighted_sample(
+        zone_ids.loc[potential_add_locations.index].values,
+        potential_add_locations.values,
+        zone_totals)
+
+    units = pd.Series(
+        potential_add_locations.index.values[draws]).value_counts()
+    df.loc[units.index, "deed_restricted_units"] += units.values
 
     print "Total deed restricted units after random selection: %d" % \
         df.deed_restricted_units.sum()
@@ -0,0 +1,560 @@
+import os
+import hashlib
+import cPickle
+import weakref
+import multiprocessing
+import numpy as np
+import pandas as pd
+import orca
+import urbansim
+from urbansim.utils import misc
+from urbansim.developer import sqftproforma
+
+
+# Feasibility used to run the pro forma over every parcel every simulated
+# year, but most parcels have the same prices, zoning and existing buildings
+# as the year before.  The pro forma lookup treats every parcel on its own,
+# so here the result of each parcel is cached along with the lookup inputs
+# it came from, and only the parcels whose inputs changed (or which weren't
+# looked up before) are run through the pro forma again.  The feasibility
+# table is put back together from the cached and the new rows.
+
+# set to False to always run the pro forma over every parcel
+USE_CACHE = True
+
+# the parcel columns (besides the price of each use) which go into the pro
+# forma lookup - the other columns of the feasibility table are copied from
+# the parcels or computed from these
+LOOKUP_INPUTS = ["land_cost", "parcel_size", "max_far", "max_height",
+                 "max_dua", "ave_unit_size"]
+
+# columns the lookup computes from the inputs, which can be passed through
+LOOKUP_COLUMNS = ["weighted_rent", "max_far_from_heights",
+                  "max_far_from_dua", "min_max_fars"]
+
+# the columns the lookup adds after the pass through columns
+TRAILING_COLUMNS = ["residential_sqft", "non_residential_sqft", "stories"]
+
+# the cached inputs and results of each form, keyed by the lookup settings
+_CACHE = {}
+
+# bump this if the way the pro formas are cached changes
+PRO_FORMA_CACHE_VERSION = 1
+
+# the pro formas built in this process, keyed by config_key
+_PRO_FORMAS = {}
+
+# don't bother starting worker processes for fewer parcels than this
+MIN_PARALLEL_PARCELS = 10000
+
+# the pro forma the worker processes use - it's set before the pool is
+# started so the workers inherit it when they're forked instead of it being
+# pickled for every chunk
+_POOL_PF = []
+
+
+# numpy reprs round to 8 digits and leave out the middle of big arrays, so
+# arrays (and numpy numbers) are hashed by their shape, type and bytes, and
+# dicts and lists by their items
+def _hash_value(h, v):
+    if isinstance(v, dict):
+        h.update("dict %d\n" % len(v))
+        for k in sorted(v.keys()):
+            h.update("%r: " % (k,))
+            _hash_value(h, v[k])
+    elif isinstance(v, (list, tuple)):
+        h.update("%s %d\n" % (type(v).__name__, len(v)))
+        for item in v:
+            _hash_value(h, item)
+    elif isinstance(v, (np.ndarray, np.generic)):
+        v = np.ascontiguousarray(v)
+        h.update("array %r %s\n" % (v.shape, v.dtype.str))
+        if v.dtype == object:
+            _hash_value(h, v.tolist())
+        else:
+            h.update(v.tobytes())
+    else:
+        h.update("%r\n" % (v,))
+
+
+def config_key(config, *extra):
+    h = hashlib.md5()
+    for item in extra:
+        h.update("%r\n" % (item,))
+    for k in sorted(vars(config).keys()):
+        h.update("%s " % k)
+        _hash_value(h, vars(config)[k])
+    return h.hexdigest()
+
+
+def pro_forma_cache_dir():
+    return os.path.join(misc.data_dir(), "pro_forma_cache")
+
+
+def pro_forma(config=None):
+    """
+    Returns sqftproforma.SqFtProForma(config), but the cost and revenue
+    lookup grids it builds for every form and far are only generated once
+    for each distinct config - they're kept for the rest of the run and
+    pickled to data/pro_forma_cache (keyed by a hash of the config) for
+    later years, scenarios and runs.
+    """
+    if config is None:
+        config = sqftproforma.SqFtProFormaConfig()
+
+    key = config_key(config, PRO_FORMA_CACHE_VERSION,
+                     getattr(urbansim, "__version__", None))
+    if key in _PRO_FORMAS:
+        return _PRO_FORMAS[key]
+
+    fname = os.path.join(pro_forma_cache_dir(), "%s.pkl" % key)
+    if os.path.exists(fname):
+        with open(fname, "rb") as f:
+            pf = cPickle.load(f)
+    else:
+        pf = sqftproforma.SqFtProForma(config)
+
+        if not os.path.exists(pro_forma_cache_dir()):
+            os.makedirs(pro_forma_cache_dir())
+        # write to a temp file first so another process never reads half a
+        # pro forma
+        tmp_fname = fname + ".%d.tmp" % os.getpid()
+        with open(tmp_fname, "wb") as f:
+            cPickle.dump(pf, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_fname, fname)
+
+    _PRO_FORMAS[key] = pf
+    return pf
+
+
+# the rows of new which are exactly the same as in old (missing values are
+# the same as each other)
+def _unchanged(new, old):
+    common = new.index[new.index.isin(old.index)]
+    a = new.loc[common].values.astype("float64")
+    b = old.loc[common, new.columns].values.astype("float64")
+    same = ((a == b) | (np.isnan(a) & np.isnan(b))).all(axis=1)
+    return common[same]
+
+
+def _order_columns(df, pass_through):
+    cols = [c for c in df.columns
+            if c not in pass_through and c not in TRAILING_COLUMNS]
+    return df[cols + list(pass_through) + TRAILING_COLUMNS]
+
+
+def _lookup_chunk(args):
+    form, df, only_built, pass_through = args
+    return _POOL_PF[0].lookup(form, df, only_built=only_built,
+                              pass_through=pass_through)
+
+
+def parallel_lookup(pf, form, df, only_built=True, pass_through=None,
+                    workers=1):
+    """
+    The same as pf.lookup(form, df, only_built, pass_through), with the
+    parcels split into equal sized chunks which are looked up by a pool of
+    worker processes.  The lookup treats every parcel on its own, so the
+    result is exactly the same as looking them all up at once.
+    """
+    if workers <= 1 or len(df) < MIN_PARALLEL_PARCELS:
+        return pf.lookup(form, df, only_built=only_built,
+                         pass_through=pass_through)
+
+    chunks = [df.iloc[rows] for rows in
+              np.array_split(np.arange(len(df)), workers)]
+
+    _POOL_PF[:] = [pf]
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(_lookup_chunk, [
+            (form, chunk, only_built, pass_through) for chunk in chunks])
+    finally:
+        pool.close()
+        pool.join()
+        _POOL_PF[:] = []
+
+    return pd.concat(results)
+
+
+def cached_lookup(pf, form, df, only_built=True, pass_through=None,
+                  key=None, workers=1):
+    """
+    The same as pf.lookup(form, df, only_built, pass_through), but only the
+    parcels whose lookup inputs changed since the last call with the same
+    key are looked up - the rest of the rows come from the cache.
+
+    Parameters
+    ----------
+    pf : SqFtProForma
+        The pro forma to run
+    form : str
+        The form to look up
+    df : DataFrame
+        The parcels the form is allowed on, with the price of each use and
+        the LOOKUP_INPUTS columns
+    only_built : bool, optional
+        Whether to only return profitable buildings
+    pass_through : list of str, optional
+        Columns of df (or LOOKUP_COLUMNS) to pass through to the result
+    key : hashable, optional
+        Identifies the cache to use, defaults to form, only_built and the
+        pro forma config
+    workers : int, optional
+        The number of processes to look up the parcels with (see
+        parallel_lookup)
+
+    Returns
+    -------
+    outdf : DataFrame
+        The result of the lookup
+    """
+    pass_through = pass_through or []
+    internal = [c for c in pass_through if c in LOOKUP_COLUMNS]
+    external = [c for c in pass_through if c not in LOOKUP_COLUMNS]
+
+    if not USE_CACHE:
+        return parallel_lookup(pf, form, df, only_built=only_built,
+                               pass_through=pass_through, workers=workers)
+
+    if key is None:
+        key = (form, only_built, config_key(pf.config))
+
+    inputs = df[pf.config.uses +
+                [c for c in LOOKUP_INPUTS if c in df.columns]].\
+        astype("float64")
+
+    cache = _CACHE.get(key)
+    if cache is None or list(cache["inputs"].columns) != \
+            list(inputs.columns) or cache["internal"] != internal:
+        unchanged = inputs.index[:0]
+        cached = None
+    else:
+        unchanged = _unchanged(inputs, cache["inputs"])
+        cached = cache["result"]
+        cached = cached.loc[cached.index[cached.index.isin(unchanged)]]
+
+    changed = df.index[~df.index.isin(unchanged)]
+    print "Feasibility for form %s: %d parcels from cache, %d looked up" % \
+        (form, len(unchanged), len(changed))
+
+    if len(changed) == 0 and cached is not None:
+        result = cached
+    else:
+        result = parallel_lookup(pf, form, df.loc[changed],
+                                 only_built=only_built,
+                                 pass_through=internal, workers=workers)
+        if cached is not None:
+            result = pd.concat([cached, result])
+            # rows are in the order of df, as they come out of the lookup
+            result = result.loc[df.index[df.index.isin(result.index)]]
+
+    _CACHE[key] = {
+        "inputs": inputs,
+        "internal": internal,
+        "result": result
+    }
+
+    result = result.copy()
+    for col in external:
+        result[col] = df.loc[result.index, col]
+
+    return _order_columns(result, pass_through)
+
+
+class FeasibilityStore(object):
+    """
+    The result of feasibility for every form over one shared parcel index.
+    The float attributes of each form (max_profit, building_sqft, ...) are
+    stored as one contiguous block with an attribute per row, so every
+    attribute is a contiguous array which profit adjustments can update in
+    place, and the attributes which aren't floats (pass through strings,
+    unit counts) are kept as separate arrays.  Parcels a form wasn't looked
+    up for (or wasn't profitable on) are missing values, as they are in the
+    wide feasibility table.
+
+    Parameters
+    ----------
+    index : Index
+        The parcel ids
+    dtype : str, optional
+        The type of the float attributes, "float32" halves the memory of the
+        blocks at the cost of precision
+    """
+    # the number of extra attribute rows allocated for every form so adding
+    # attributes (fees etc) doesn't have to copy the block
+    SPARE_COLUMNS = 8
+
+    def __init__(self, index, dtype="float64"):
+        self.index = index
+        self.dtype = np.dtype(dtype)
+        self.forms = []
+        self._columns = {}
+        self._blocks = {}
+        self._rows = {}
+        self._other = {}
+        # the arrays column() has handed out of each form's block
+        self._views = {}
+
+    @classmethod
+    def from_frames(cls, frames, forms=None, dtype="float64"):
+        """
+        Make a store from a dict of the feasibility DataFrame of each form,
+        indexed by parcel id, over the union of their indexes (like
+        concatenating them into the wide feasibility table).
+        """
+        forms = forms or frames.keys()
+        index = frames[forms[0]].index
+        for form in forms[1:]:
+            index = index.union(frames[form].index)
+
+        store = cls(index, dtype=dtype)
+        for form in forms:
+            store.add_form(form, frames[form].reindex(index))
+        return store
+
+    @classmethod
+    def from_frame(cls, df, dtype="float64"):
+        """
+        Make a store from the wide feasibility table, with (form, attribute)
+        columns.
+        """
+        forms = []
+        for form in df.columns.get_level_values(0):
+            if form not in forms:
+                forms.append(form)
+
+        store = cls(df.index, dtype=dtype)
+        for form in forms:
+            store.add_form(form, df[form])
+        return store
+
+    @classmethod
+    def from_long(cls, df, dtype="float64"):
+        """
+        Make a store from the feasibility in long format (see to_long).
+        """
+        frames = {}
+        for form in df.form.unique():
+            frames[form] = df[df.form == form].drop("form", axis=1).\
+                dropna(axis=1, how="all")
+        return cls.from_frames(frames, forms=list(df.form.unique()),
+                               dtype=dtype)
+
+    def add_form(self, form, df):
+        """
+        Add the attributes of a form, df has to be indexed like the store.
+        """
+        self.forms.append(form)
+        self._columns[form] = []
+        self._blocks[form] = np.empty(
+            (self.SPARE_COLUMNS, len(self.index)), dtype=self.dtype)
+        self._rows[form] = {}
+        self._other[form] = {}
+        self._views[form] = weakref.WeakValueDictionary()
+
+        floats = [col for col in df.columns if df[col].dtype.kind == "f"]
+        self._grow(form, len(floats))
+        for col in df.columns:
+            self.add_column(form, col, df[col].values)
+
+    def _grow(self, form, num):
+        block = self._blocks[form]
+        if len(self._rows[form]) + num <= len(block):
+            return
+        new = np.empty((len(self._rows[form]) + num + self.SPARE_COLUMNS,
+                        len(self.index)), dtype=self.dtype)
+        new[:len(self._rows[form])] = block[:len(self._rows[form])]
+        self._blocks[form] = new
+
+        # the arrays column() handed out are still views into the old block,
+        # so writing to them wouldn't update the store any more - make them
+        # read only so that fails loudly, and column() has to be called again
+        for values in self._views[form].values():
+            values.flags.writeable = False
+        self._views[form].clear()
+
+    def has_column(self, form, col):
+        return form in self._columns and col in self._columns[form]
+
+    def columns(self, form):
+        return list(self._columns[form])
+
+    def add_column(self, form, col, values):
+        """
+        Add (or replace) an attribute of a form - float attributes are
+        copied into the form's block, anything else is kept as is.  An
+        attribute keeps the kind it was first added with.
+        """
+        values = np.asarray(values)
+        if col in self._rows[form]:
+            self._blocks[form][self._rows[form][col]] = values
+            return
+
+        if col not in self._columns[form]:
+            self._columns[form].append(col)
+
+        if col in self._other[form] or values.dtype.kind != "f":
+            self._other[form][col] = values
+        else:
+            self._grow(form, 1)
+            self._rows[form][col] = len(self._rows[form])
+            self._blocks[form][self._rows[form][col]] = values
+
+    def column(self, form, col):
+        """
+        An attribute of a form as an array - for float attributes this is a
+        view into the block, so updating it in place updates the store.  The
+        view becomes read only when adding attributes moves the block.
+        """
+        if col in self._rows[form]:
+            values = self._blocks[form][self._rows[form][col]]
+            self._views[form][id(values)] = values
+            return values
+        return self._other[form][col]
+
+    def view(self, form):
+        """
+        A DataFrame of the attributes of a form - the float attributes come
+        first and are a view into the block rather than a copy.
+        """
+        rows = self._rows[form]
+        cols = sorted(rows.keys(), key=rows.get)
+        block = self._blocks[form][:len(cols)]
+        df = pd.DataFrame(block.T, index=self.index, columns=cols,
+                          copy=False)
+        for col in self._columns[form]:
+            if col in self._other[form]:
+                df[col] = self._other[form][col]
+        return df
+
+    def frame(self, form):
+        # the attributes of a form in the order they were added
+        return self.view(form)[self._columns[form]]
+
+    def feasible(self, form):
+        """
+        A DataFrame of the attributes of a form, in the order they were
+        added, for the parcels which have a max_profit - only these rows are
+        copied out of the block.
+        """
+        df = self.view(form)
+        return df.loc[df.max_profit.notnull(), self._columns[form]]
+
+    def to_frame(self):
+        """
+        The wide feasibility table, with (form, attribute) columns.
+        """
+        if not self.forms:
+            return pd.DataFrame(index=self.index)
+        return pd.concat([self.frame(form) for form in self.forms],
+                         keys=self.forms, axis=1)
+
+    def to_long(self):
+        """
+        The feasibility in long format - a row for every parcel and form
+        which has any attributes, with a form column.
+        """
+        dfs = []
+        for form in self.forms:
+            df = self.frame(form).dropna(how="all")
+            df.insert(0, "form", form)
+            dfs.append(df)
+        df = pd.concat(dfs)
+        df.index.name = "parcel_id"
+        return df
+
+
+def run_feasibility(parcels, parcel_price_callback,
+                    parcel_use_allowed_callback, residential_to_yearly=True,
+                    parcel_filter=None, only_built=True, forms_to_test=None,
+                    config=None, pass_through=[], simple_zoning=False,
+                    workers=1, cache_name=None, dtype="float64"):
+    """
+    Execute development feasibility on all parcels - this is
+    urbansim_defaults.utils.run_feasibility with the pro forma lookup
+    cached between calls (see cached_lookup), so it takes the same
+    parameters and adds the same feasibility table.  The parcels which
+    aren't in the cache are looked up by a pool of worker processes when
+    workers is more than 1.  Every step which runs feasibility should pass
+    its own cache_name, so the steps which run in the same year on
+    different parcels don't evict each other's cached rows.  dtype is the
+    type the store keeps the float attributes as.
+
+    Returns the FeasibilityStore the feasibility table is made from, which
+    is also the feasibility_store injectable.
+    """
+    pf = pro_forma(config)
+
+    df = parcels.to_frame()
+
+    if parcel_filter:
+        df = df.query(parcel_filter)
+
+    # add prices for each use
+    for use in pf.config.uses:
+        # assume we can get the 80th percentile price for new development
+        df[use] = parcel_price_callback(use)
+
+    # convert from cost to yearly rent
+    if residential_to_yearly:
+        df["residential"] *= pf.config.cap_rate
+
+    print "Describe of the yearly rent by use"
+    print df[pf.config.uses].describe()
+
+    d = {}
+    forms = forms_to_test or pf.config.forms
+    for form in forms:
+        print "Computing feasibility for form %s" % form
+        allowed = parcel_use_allowed_callback(form).loc[df.index]
+
+        newdf = df[allowed]
+        if simple_zoning:
+            if form == "residential":
+                # these are new computed in the effective max_dua method
+                newdf["max_far"] = pd.Series()
+                newdf["max_height"] = pd.Series()
+            else:
+                # these are new computed in the effective max_far method
+                newdf["max_dua"] = pd.Series()
+                newdf["max_height"] = pd.Series()
+
+        d[form] = cached_lookup(pf, form, newdf, only_built=only_built,
+                                pass_through=pass_through,
+                                key=(cache_name, form, only_built,
+                                     simple_zoning, parcel_filter,
+                                     tuple(pass_through),
+                                     config_key(pf.config)),
+                                workers=workers)
+        if residential_to_yearly and "residential" in pass_through:
+            d[form]["residential"] /= pf.config.cap_rate
+
+    store = FeasibilityStore.from_frames(d, forms=d.keys(), dtype=dtype)
+    add_feasibility_table(store)
+    return store
+
+
+# the wide feasibility table is only made from the store when a step asks
+# for it (the developers in urbansim need it) and isn't cached, so the store
+# is the only copy of the feasibility which is kept around
+def add_feasibility_table(store):
+    def feasibility():
+        return store.to_frame()
+
+    orca.add_injectable("feasibility_store", store)
+    orca.add_table("feasibility", feasibility, cache=False)
+
+
+# urbansim's developer replaces the feasibility table with a DataFrame of
+# the parcels it didn't build on - make the store from that table, so the
+# steps which read the store after a developer see the same parcels as the
+# ones which read the table
+def sync_feasibility_store():
+    table = orca.get_table("feasibility")
+    if not isinstance(table, orca.DataFrameWrapper):
+        return
+
+    dtype = orca.get_injectable("feasibility_store").dtype
+    add_feasibility_table(FeasibilityStore.from_frame(table.local,
+                                                      dtype=dtype))
@@ -6,8 +6,7 @@ import yaml
 import datasources
 import variables
 from utils import parcel_id_to_geom_id, geom_id_to_parcel_id, add_buildings
-from utils import round_series_match_target, groupby_random_choice
-from urbansim.utils import networks
+from utils import round_series_match_target
 import pandana.network as pdna
 from urbansim_defaults import models
 from urbansim_defaults import utils
@@ -15,8 +14,16 @@ from urbansim.developer import sqftproforma, developer
 from urbansim.developer.developer import Developer as dev
 import subsidies
 import summaries
+import checkpoint
+import bake
+import sampling
+import network_cache
+import accessibility
+from feasibility import run_feasibility, add_feasibility_table, \
+    sync_feasibility_store
 import numpy as np
 import pandas as pd
+from collections import OrderedDict
 
 
 @orca.step('rsh_simulate')
@@ -41,16 +48,20 @@ def hlcm_simulate(households, buildings, aggregations, settings, low_income):
 
     cfg = yaml.load(open(fname))
     cfg["choosers_predict_filters"] = "income <= %d" % low_income
-    open(misc.config("hlcm_tmp.yaml"), "w").write(yaml.dump(cfg))
-
-    # low income into affordable units
-    utils.lcm_simulate("hlcm_tmp.yaml", households, buildings,
-                       aggregations,
-                       "building_id", "residential_units",
-                       "vacant_affordable_units",
-                       settings.get("enable_supply_correction", None))
-
-    os.remove(misc.config("hlcm_tmp.yaml"))
+    # runs can share a checkout (see all.py and server.py), so each process
+    # writes its own temporary config
+    tmp_fname = "hlcm_tmp_%d.yaml" % os.getpid()
+    open(misc.config(tmp_fname), "w").write(yaml.dump(cfg))
+
+    try:
+        # low income into affordable units
+        utils.lcm_simulate(tmp_fname, households, buildings,
+                           aggregations,
+                           "building_id", "residential_units",
+                           "vacant_affordable_units",
+                           settings.get("enable_supply_correction", None))
+    finally:
+        os.remove(misc.config(tmp_fname))
 
     print "\nMarket rate housing HLCM:\n"
 
@@ -156,10 +167,12 @@ def _proportional_jobs_model(
 
     print "Need more jobs\n", need_more_jobs
 
-    choices = groupby_random_choice(locations_series, need_more_jobs)
-
     # choose random locations within jurises to match need_more_jobs totals
-    return pd.Series(choices.index, available_jobs.index)
+    choices = sampling.grouped_sample(locations_series.values,
+                                      need_more_jobs, replace=True)
+
+    return pd.Series(locations_series.index.values[choices],
+                     available_jobs.index)
 
 
 @orca.step()
@@ -171,9 +184,12 @@ def additional_units(year, buildings, parcels):
 
     res_buildings = buildings_juris[buildings.general_type == "Residential"]
 
-    add_buildings = groupby_random_choice(res_buildings, add_units)
+    # each unit goes to a random residential building in the juris
+    add_buildings = pd.Series(sampling.grouped_sample_counts(
+        res_buildings.values, np.ones(len(res_buildings)),
+        add_units.fillna(0), replace=True), index=res_buildings.index)
 
-    add_buildings = pd.Series(add_buildings.index).value_counts()
+    add_buildings = add_buildings[add_buildings > 0]
 
     buildings.local.loc[add_buildings.index, "residential_units"] += add_buildings.values
 
@@ -443,17 +459,16 @@ def alt_feasibility(parcels, settings,
     config.building_efficiency = .85
     config.parcel_coverage = .85
 
-    utils.run_feasibility(parcels,
-                          parcel_sales_price_sqft_func,
-                          parcel_is_allowed_func,
-                          config=config,
-                          **kwargs)
+    feasibility = run_feasibility(parcels,
+                                  parcel_sales_price_sqft_func,
+                                  parcel_is_allowed_func,
+                                  config=config,
+                                  cache_name="alt_feasibility",
+                                  **kwargs)
 
-    f = subsidies.policy_modifications_of_profit(
-        orca.get_table('feasibility').to_frame(),
-        parcels)
+    subsidies.policy_modifications_of_profit(feasibility, parcels)
 
-    orca.add_table("feasibility", f)
+    add_feasibility_table(feasibility)
 
 
 @orca.step('residential_developer')
@@ -560,9 +575,11 @@ def residential_developer(feasibility, households, buildings, parcels, year,
 
         summary.add_parcel_output(new_buildings)
 
+    sync_feasibility_store()
+
 
 @orca.step()
-def retail_developer(jobs, buildings, parcels, nodes, feasibility,
+def retail_developer(jobs, buildings, parcels, nodes, feasibility_store,
                      settings, summary, add_extra_columns_func, net):
 
     dev_settings = settings['non_residential_developer']
@@ -575,8 +592,7 @@ def retail_developer(jobs, buildings, parcels, nodes, feasibility,
     # target here is in sqft
     target *= settings["building_sqft_per_job"][10]
 
-    feasibility = feasibility.to_frame().loc[:, "retail"]
-    feasibility = feasibility.dropna(subset=["max_profit"])
+    feasibility = feasibility_store.feasible("retail")
 
     feasibility["non_residential_sqft"] = \
         feasibility.non_residential_sqft.astype("int")
@@ -742,6 +758,8 @@ def office_developer(feasibility, jobs, buildings, parcels, year,
 
             summary.add_parcel_output(new_buildings)
 
+    sync_feasibility_store()
+
 
 @orca.step()
 def developer_reprocess(buildings, year, years_per_iter, jobs,
@@ -882,12 +900,20 @@ def static_parcel_proportional_job_allocation(static_parcels):
         proportional_job_allocation(parcel_id)
 
 
-def make_network(name, weight_col, max_distance):
-    st = pd.HDFStore(os.path.join(misc.data_dir(), name), "r")
-    nodes, edges = st.nodes, st.edges
-    net = pdna.Network(nodes["x"], nodes["y"], edges["from"], edges["to"],
-                       edges[[weight_col]])
+def make_network(name, weight_col, max_distance, twoway=True):
+    key, a = network_cache.network_arrays(name, weight_col)
+    net = pdna.Network(pd.Series(a["x"], index=a["node_id"]),
+                       pd.Series(a["y"], index=a["node_id"]),
+                       pd.Series(a["from"]), pd.Series(a["to"]),
+                       pd.DataFrame({weight_col: a["weight"]}),
+                       twoway=twoway)
     net.precompute(max_distance)
+    # so node id lookups on this network can be cached as well
+    net.cache_key = key
+    # and so accessibility can find the nodes near a changed node, in the
+    # direction pandana searches the network
+    net.graph_arrays = a
+    net.twoway = twoway
     return net
 
 
@@ -895,7 +921,8 @@ def make_network_from_settings(settings):
     return make_network(
         settings["name"],
         settings.get("weight_col", "weight"),
-        settings['max_distance']
+        settings['max_distance'],
+        settings.get("twoway", True)
     )
 
 
@@ -915,39 +942,59 @@ def build_networks(settings):
     return nets
 
 
-@orca.step('local_pois')
-def local_pois(settings):
-    # because of the aforementioned limit of one netowrk at a time for the
-    # POIS, as well as the large amount of memory used, this is now a
-    # preprocessing step
-    n = make_network(
-        settings['build_networks']['walk']['name'],
-        "weight", 3000)
+# the points of interest of each category in the poi_distances settings -
+# bart stations, landmarks (all of landmarks.csv unless they're listed) and
+# any other csvs with lng and lat columns
+def poi_categories(cfg, landmarks):
+    pois = OrderedDict()
+
+    if cfg.get("bart_stations", False):
+        locations = pd.read_csv(
+            os.path.join(misc.data_dir(), 'bart_stations.csv'))
+        pois["bartdist"] = (locations.lng, locations.lat)
 
-    n.init_pois(
-        num_categories=1,
-        max_dist=3000,
-        max_pois=1)
+    landmarks = landmarks.to_frame()
+    for locname in cfg.get("landmarks", landmarks.index):
+        locs = landmarks.loc[[locname]]
+        pois[locname] = (locs.lng, locs.lat)
 
-    cols = {}
+    for name, fname in cfg.get("csvs", {}).items():
+        locations = pd.read_csv(fname)
+        pois[name] = (locations.lng, locations.lat)
 
-    locations = pd.read_csv(os.path.join(misc.data_dir(), 'bart_stations.csv'))
-    n.set_pois("tmp", locations.lng, locations.lat)
-    cols["bartdist"] = n.nearest_pois(3000, "tmp", num_pois=1)[1]
+    return pois
 
-    locname = 'pacheights'
-    locs = orca.get_table('landmarks').local.query("name == '%s'" % locname)
-    n.set_pois("tmp", locs.lng, locs.lat)
-    cols["pacheights"] = n.nearest_pois(3000, "tmp", num_pois=1)[1]
 
-    df = pd.DataFrame(cols)
-    df.index.name = "node_id"
-    df.to_csv('local_poi_distances.csv')
+def write_poi_distances(settings, landmarks, key):
+    cfg = settings["poi_distances"][key]
+    name = settings["build_networks"][cfg["network"]]["name"]
+    _, a = network_cache.network_arrays(name, cfg.get("weight_col", "weight"))
+
+    df = accessibility.nearest_poi_distances(
+        a, poi_categories(cfg, landmarks), cfg["max_distance"])
+    df.index.name = cfg["node_col"]
+
+    print df.describe()
+    df.to_hdf(cfg["output"], "poi_distances", mode="w")
+
+
+# this is a preprocessing step which computes the distance from every node
+# of the networks in the poi_distances settings to the nearest poi of each
+# category, and writes them to hdf5 files for the accessibility steps
+@orca.step('poi_distances')
+def poi_distances(settings, landmarks):
+    for key in settings["poi_distances"].keys():
+        write_poi_distances(settings, landmarks, key)
+
+
+@orca.step('local_pois')
+def local_pois(settings, landmarks):
+    write_poi_distances(settings, landmarks, "local")
 
 
 @orca.step('neighborhood_vars')
 def neighborhood_vars(net):
-    nodes = networks.from_yaml(net["walk"], "neighborhood_vars.yaml")
+    nodes = accessibility.from_yaml(net["walk"], "neighborhood_vars.yaml")
     nodes = nodes.replace(-np.inf, np.nan)
     nodes = nodes.replace(np.inf, np.nan)
     nodes = nodes.fillna(0)
@@ -960,13 +1007,11 @@ def neighborhood_vars(net):
 
 
 @orca.step('regional_vars')
-def regional_vars(net):
-    nodes = networks.from_yaml(net["drive"], "regional_vars.yaml")
+def regional_vars(net, regional_poi_distances):
+    nodes = accessibility.from_yaml(net["drive"], "regional_vars.yaml")
     nodes = nodes.fillna(0)
 
-    nodes2 = pd.read_csv('data/regional_poi_distances.csv',
-                         index_col="tmnode_id")
-    nodes = pd.concat([nodes, nodes2], axis=1)
+    nodes = pd.concat([nodes, regional_poi_distances.local], axis=1)
 
     print nodes.describe()
     orca.add_table("tmnodes", nodes)
@@ -974,38 +1019,19 @@ def regional_vars(net):
 
 @orca.step('regional_pois')
 def regional_pois(settings, landmarks):
-    # because of the aforementioned limit of one netowrk at a time for the
-    # POIS, as well as the large amount of memory used, this is now a
-    # preprocessing step
-    n = make_network(
-        settings['build_networks']['drive']['name'],
-        "CTIMEV", 75)
-
-    n.init_pois(
-        num_categories=1,
-        max_dist=75,
-        max_pois=1)
-
-    cols = {}
-    for locname in ["embarcadero", "stanford", "pacheights"]:
-        locs = landmarks.local.query("name == '%s'" % locname)
-        n.set_pois("tmp", locs.lng, locs.lat)
-        cols[locname] = n.nearest_pois(75, "tmp", num_pois=1)[1]
-
-    df = pd.DataFrame(cols)
-    print df.describe()
-    df.index.name = "tmnode_id"
-    df.to_csv('regional_poi_distances.csv')
+    write_poi_distances(settings, landmarks, "regional")
 
 
 @orca.step('price_vars')
 def price_vars(net):
-    nodes2 = networks.from_yaml(net["walk"], "price_vars.yaml")
+    nodes2 = accessibility.from_yaml(net["walk"], "price_vars.yaml")
     nodes2 = nodes2.fillna(0)
     print nodes2.describe()
+    # nodes has the same index (the walk network's node ids) so the price
+    # columns can just be added to it
     nodes = orca.get_table('nodes')
-    nodes = nodes.to_frame().join(nodes2)
-    orca.add_table("nodes", nodes)
+    for col in nodes2.columns:
+        nodes.update_col(col, nodes2[col])
 
 
 # this is not really simulation - just writing a method to get average
@@ -1051,6 +1077,10 @@ def correct_baseyear_data(buildings, parcels, jobs):
     # as opposed to in datasources as it requires registered orca
     # variables
 
+    if "buildings" in bake.LOADED:
+        print "Base year snapshot already has corrected base year data"
+        return
+
     '''
     These are the original vacancies
     Alameda          0.607865
@@ -0,0 +1,116 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from urbansim.utils import misc
+
+
+# every run (and every scenario worker in a package) used to read the
+# nodes and edges of each network out of hdf5 and look up the nearest node
+# of every parcel again.  Here the network arrays and the node lookups are
+# saved as .npy files in data/network_cache the first time they're built
+# and memory mapped after that, so parallel workers share one copy in the
+# os page cache.  pandana keeps what precompute builds in C++ memory with
+# no way to save it, so that part still runs in every process.
+
+# bump this if the way the cached arrays are made changes
+CACHE_VERSION = 1
+
+NETWORK_ARRAYS = ["node_id", "x", "y", "from", "to", "weight"]
+
+
+def cache_dir():
+    return os.path.join(misc.data_dir(), "network_cache")
+
+
+def _md5(*items):
+    h = hashlib.md5()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            h.update(np.ascontiguousarray(item).view(np.uint8))
+        else:
+            h.update(str(item))
+        h.update("|")
+    return h.hexdigest()
+
+
+# the network h5 files are identified by their size and modification time
+# so they don't have to be read to check the cache
+def network_key(name, weight_col):
+    st = os.stat(os.path.join(misc.data_dir(), name))
+    return _md5(CACHE_VERSION, name, st.st_size, int(st.st_mtime),
+                weight_col)
+
+
+def _fname(key, array_name):
+    return os.path.join(cache_dir(), "%s_%s.npy" % (key, array_name))
+
+
+def _save(key, arrays):
+    if not os.path.exists(cache_dir()):
+        os.makedirs(cache_dir())
+
+    for array_name, arr in arrays.items():
+        # write to a temp file first so another process never memory maps
+        # half an array
+        fname = _fname(key, array_name)
+        tmp_fname = fname + ".%d.tmp" % os.getpid()
+        with open(tmp_fname, "wb") as f:
+            np.save(f, arr)
+        os.rename(tmp_fname, fname)
+
+
+def _load(key, array_names):
+    fnames = [_fname(key, array_name) for array_name in array_names]
+    if not all(os.path.exists(fname) for fname in fnames):
+        return None
+    return {array_name: np.load(fname, mmap_mode="r")
+            for array_name, fname in zip(array_names, fnames)}
+
+
+# returns the key of the network and a dict of the arrays which make up the
+# network (see NETWORK_ARRAYS), read from the cache if possible
+def network_arrays(name, weight_col):
+    key = network_key(name, weight_col)
+
+    arrays = _load(key, NETWORK_ARRAYS)
+    if arrays is not None:
+        return key, arrays
+
+    st = pd.HDFStore(os.path.join(misc.data_dir(), name), "r")
+    nodes, edges = st.nodes, st.edges
+    st.close()
+
+    arrays = {
+        "node_id": nodes.index.values,
+        "x": nodes["x"].values,
+        "y": nodes["y"].values,
+        "from": edges["from"].values,
+        "to": edges["to"].values,
+        "weight": edges[weight_col].values
+    }
+
+    # only numeric arrays can be memory mapped
+    if all(arr.dtype != object for arr in arrays.values()):
+        _save(key, arrays)
+
+    return key, arrays
+
+
+# net.get_node_ids(x, y), cached by the network and the coordinates
+def node_ids(net, x, y):
+    key = getattr(net, "cache_key", None)
+    if key is None:
+        return net.get_node_ids(x, y)
+
+    key = _md5(key, "node_ids", x.index.values, x.values, y.values)
+
+    arrays = _load(key, ["index", "node_id"])
+    if arrays is not None:
+        return pd.Series(np.asarray(arrays["node_id"]),
+                         index=np.asarray(arrays["index"]))
+
+    s = net.get_node_ids(x, y)
+    if s.index.dtype != object:
+        _save(key, {"index": s.index.values, "node_id": s.values})
+    return s
@@ -0,0 +1,180 @@
+import os
+import time
+import resource
+import pandas as pd
+import orca
+
+
+# this records wall time, cpu time and memory use for every orca step that
+# gets run.  orca.run looks steps up by name in orca's step registry each
+# time it runs them, so we swap each registered step for a thin wrapper that
+# measures the call and then delegates to the real step - this means steps
+# that other steps run via orca.eval_step get measured as well
+
+
+def _rss_mb():
+    # current resident set size - /proc is only available on linux, so fall
+    # back to the peak rss on other platforms
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 1024.0 / 1024.0
+    except (IOError, OSError, IndexError, ValueError):
+        return _peak_rss_mb()
+
+
+def _peak_rss_mb():
+    # the high-water mark of the resident set size, which _reset_peak_rss
+    # resets on linux - elsewhere it's the peak of the whole process so far
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+
+    # ru_maxrss is in kilobytes on linux and bytes on osx
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if os.uname()[0] == "Darwin":
+        peak /= 1024.0
+    return peak / 1024.0
+
+
+def _reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM to the current rss (linux 4.0+)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        pass
+
+
+def _cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+
+def _iter_var():
+    try:
+        return orca.get_injectable("iter_var")
+    except KeyError:
+        return None
+
+
+class _ProfiledStep(object):
+
+    def __init__(self, profiler, name, step):
+        self.profiler = profiler
+        self.name = name
+        self.step = step
+
+    def __call__(self):
+        return self.profiler.measure(self.name, self.step)
+
+    def __getattr__(self, attr):
+        # anything orca asks of the step other than calling it (e.g. the
+        # list of injectables it needs) goes to the real step
+        return getattr(self.step, attr)
+
+
+class StepProfiler(object):
+    """
+    Times every orca step and keeps one record per (step, year).
+
+    Call install() once all the steps are registered (i.e. after importing
+    baus.models) and the profiler will measure every step orca runs from
+    then on.  Steps run from inside other steps (via orca.eval_step) are
+    recorded with the name of the step that ran them as the parent.
+
+    peak_rss_mb is the peak memory use during the step (including the
+    steps it ran) on linux, where the high-water mark can be reset before
+    each step - on other platforms it's the peak of the process so far.
+    """
+
+    columns = ["step", "year", "parent", "wall_time", "cpu_time",
+               "rss_mb", "rss_delta_mb", "peak_rss_mb"]
+
+    def __init__(self):
+        self.records = []
+        self._stack = []
+        # the peak rss of each step on the stack so far
+        self._peaks = []
+
+    def install(self):
+        steps = orca.orca._STEPS
+        for name, step in steps.items():
+            if not isinstance(step, _ProfiledStep):
+                steps[name] = _ProfiledStep(self, name, step)
+
+    def measure(self, name, step):
+        parent = self._stack[-1] if self._stack else None
+        self._stack.append(name)
+
+        # resetting the high-water mark for this step loses the parent's
+        # peak, so keep it
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], _peak_rss_mb())
+        self._peaks.append(0)
+        _reset_peak_rss()
+
+        rss_before = _rss_mb()
+        cpu_before = _cpu_time()
+        wall_before = time.time()
+
+        try:
+            return step()
+        finally:
+            wall_time = time.time() - wall_before
+            cpu_time = _cpu_time() - cpu_before
+            rss_after = _rss_mb()
+            peak = max(self._peaks.pop(), _peak_rss_mb())
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], peak)
+            self._stack.pop()
+            self.records.append((
+                name, _iter_var(), parent, wall_time, cpu_time,
+                rss_after, rss_after - rss_before, peak))
+
+    def to_frame(self):
+        return pd.DataFrame(self.records, columns=self.columns)
+
+    def write_csv(self, fname, resumed_from=None):
+        """
+        Write the records to fname.  A run resumed from the checkpoint of a
+        year keeps the records the run wrote before (for that year and
+        earlier, and for steps run outside the years) and adds its own.
+        """
+        df = self.to_frame()
+        if resumed_from is not None and os.path.exists(fname):
+            old = pd.read_csv(fname)
+            old = old[old.year.isnull() | (old.year <= resumed_from)]
+            df = pd.concat([old, df])[self.columns]
+        df.to_csv(fname, index=False)
+
+    def summary(self, top=None):
+        # only rank the top level steps - nested steps are already counted
+        # in the time of the step that ran them
+        df = self.to_frame()
+        df = df[df.parent.isnull()]
+        if len(df) == 0:
+            return "No steps were profiled"
+
+        # count rows rather than years, since steps which run outside of the
+        # year loop don't have a year
+        df = df.assign(calls=1).groupby("step").agg({
+            "wall_time": "sum",
+            "cpu_time": "sum",
+            "rss_delta_mb": "sum",
+            "peak_rss_mb": "max",
+            "calls": "sum"
+        })
+        df = df.sort_values("wall_time", ascending=False)
+        df["pct_wall_time"] = df.wall_time / df.wall_time.sum() * 100.0
+
+        if top is not None:
+            df = df.head(top)
+
+        return df[["calls", "wall_time", "pct_wall_time", "cpu_time",
+                   "rss_delta_mb", "peak_rss_mb"]].to_string(
+            float_format=lambda x: "%.1f" % x)
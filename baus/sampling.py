@@ -0,0 +1,261 @@
+import numpy as np
+import pandas as pd
+
+
+#####################
+# GROUPED SAMPLING
+#####################
+
+# Sampling "n rows from each group" by masking the whole table once per
+# group is O(groups x rows), which is painfully slow for ~1,500 zones and
+# ~2M buildings.  The functions here sort the rows by group once and then
+# sample every group in a single vectorized pass.  All of them take an
+# optional rng (a np.random.RandomState) and fall back to the global numpy
+# random state, so np.random.seed keeps working as before.
+
+
+def _rng(rng):
+    return np.random if rng is None else rng
+
+
+# turn the groups (which might be strings, e.g. jurisdiction names) into
+# integer codes which sort quickly, and look up the codes of the labels -
+# labels which aren't in groups get a code no item has
+def _codes(groups, labels):
+    codes, uniques = pd.factorize(groups)
+    label_codes = pd.Index(uniques).get_indexer(labels)
+    label_codes[label_codes == -1] = len(uniques)
+    return codes, label_codes
+
+
+# sort the groups once and return the sort order, the sorted groups, and
+# the start and end (exclusive) of each of the requested labels in the
+# sorted array
+def _group_slices(groups, labels):
+    groups, labels = _codes(groups, labels)
+    order = np.argsort(groups, kind="mergesort")
+    sorted_groups = groups[order]
+    starts = np.searchsorted(sorted_groups, labels, side="left")
+    ends = np.searchsorted(sorted_groups, labels, side="right")
+    return order, starts, ends
+
+
+def grouped_weighted_sample(groups, weights, counts, rng=None):
+    """
+    Draw counts[g] items with replacement from each group g, with
+    probability proportional to weights - the same as calling
+    Series.sample(cnt, replace=True, weights=weights) separately for
+    the rows of every group.
+
+    Parameters
+    ----------
+    groups : array-like
+        The group of each item
+    weights : array-like
+        The (non-negative) weight of each item
+    counts : Series
+        Index is group labels, values are the number of items to draw
+        from that group
+    rng : RandomState, optional
+        Random number generator, defaults to the global numpy one
+
+    Returns
+    -------
+    positions : ndarray
+        Positions into groups / weights of the items drawn, ordered by
+        group in the order of counts
+    """
+    groups = np.asarray(groups)
+    weights = np.asarray(weights, dtype="float64")
+    counts = counts[counts > 0]
+    labels = counts.index.values
+    cnts = counts.values.astype("int64")
+
+    order, starts, ends = _group_slices(groups, labels)
+
+    cumweights = np.cumsum(weights[order])
+    lower = np.where(starts > 0, cumweights[np.maximum(starts - 1, 0)], 0.0)
+    upper = np.where(ends > 0, cumweights[np.maximum(ends - 1, 0)], 0.0)
+
+    empty = upper <= lower
+    if empty.any():
+        raise ValueError("No items with positive weight to sample from in "
+                         "groups: %s" % labels[empty].tolist())
+
+    # a uniform number in each group's slice of the cumulative weights
+    # picks the item whose slice it falls into
+    u = np.repeat(lower, cnts) + \
+        _rng(rng).random_sample(cnts.sum()) * np.repeat(upper - lower, cnts)
+    pos = np.searchsorted(cumweights, u, side="right")
+    # guard against floating point error at the top of the last slice
+    pos = np.minimum(pos, np.repeat(ends - 1, cnts))
+
+    return order[pos]
+
+
+def grouped_sample(groups, counts, weights=None, replace=False, rng=None):
+    """
+    Draw counts[g] items from each group g, with or without replacement
+    and optionally weighted - the same as concatenating
+    Series.sample(cnt, replace=replace, weights=weights) for every group,
+    but done with a single sort of the items.
+
+    Parameters
+    ----------
+    groups : array-like
+        The group of each item
+    counts : Series
+        Index is group labels, values are the number of items to draw
+        from that group
+    weights : array-like, optional
+        The (non-negative) weight of each item, items are equally likely
+        if this isn't passed
+    replace : bool, optional
+        Whether to sample with replacement
+    rng : RandomState, optional
+        Random number generator, defaults to the global numpy one
+
+    Returns
+    -------
+    positions : ndarray
+        Positions into groups of the items drawn, ordered by group in the
+        order of counts
+    """
+    groups = np.asarray(groups)
+    if weights is None:
+        weights = np.ones(len(groups))
+
+    if replace:
+        return grouped_weighted_sample(groups, weights, counts, rng=rng)
+
+    weights = np.asarray(weights, dtype="float64")
+    counts = counts[counts > 0]
+    cnts = counts.values.astype("int64")
+
+    # give every item a random key and take the items with the largest keys
+    # in each group - with weights these are the Efraimidis-Spirakis keys
+    # u ** (1 / w), compared as logs so small weights don't underflow
+    u = _rng(rng).random_sample(len(groups))
+    with np.errstate(divide="ignore"):
+        keys = np.log(u) / weights
+    keys[weights <= 0] = -np.inf
+
+    codes, label_codes = _codes(groups, counts.index.values)
+    order = np.lexsort((-keys, codes))
+    sorted_codes = codes[order]
+    starts = np.searchsorted(sorted_codes, label_codes, side="left")
+    ends = np.searchsorted(sorted_codes, label_codes, side="right")
+
+    too_many = cnts > ends - starts
+    if too_many.any():
+        raise ValueError("Can't draw more items than there are without "
+                         "replacement in groups: %s" %
+                         counts.index.values[too_many].tolist())
+
+    offsets = np.arange(cnts.sum()) - np.repeat(np.cumsum(cnts) - cnts, cnts)
+    return order[np.repeat(starts, cnts) + offsets]
+
+
+# split n draws between the two halves of every segment of items, then
+# split the halves, and so on until every segment is a single item - this
+# is a multinomial (with replacement) or multivariate hypergeometric
+# (without replacement) draw for every segment at once, which takes
+# log2(items) vectorized steps
+def _split_counts(sizes, starts, ends, n, replace, rng):
+    out = np.zeros(len(sizes), dtype="int64")
+    cumsizes = np.concatenate([[0], np.cumsum(sizes)])
+
+    keep = n > 0
+    starts, ends, n = starts[keep], ends[keep], n[keep]
+
+    while len(starts):
+        single = ends - starts == 1
+        out[starts[single]] = n[single]
+        starts, ends, n = starts[~single], ends[~single], n[~single]
+
+        mid = (starts + ends) // 2
+        left = cumsizes[mid] - cumsizes[starts]
+        right = cumsizes[ends] - cumsizes[mid]
+
+        if replace:
+            total = left + right
+            p = np.where(total > 0, left / np.maximum(total, 1e-300), 0)
+            n_left = rng.binomial(n, np.clip(p, 0, 1))
+        else:
+            left = left.astype("int64")
+            right = right.astype("int64")
+            # numpy's hypergeometric needs at least one of each kind of item
+            # and a non-empty sample
+            n_left = np.where(right == 0, n, 0)
+            mixed = (left > 0) & (right > 0)
+            if mixed.any():
+                n_left[mixed] = rng.hypergeometric(
+                    left[mixed], right[mixed], n[mixed])
+
+        starts = np.concatenate([starts, mid])
+        ends = np.concatenate([mid, ends])
+        n = np.concatenate([n_left, n - n_left])
+
+        keep = n > 0
+        starts, ends, n = starts[keep], ends[keep], n[keep]
+
+    return out
+
+
+def grouped_sample_counts(groups, sizes, counts, replace=False, rng=None):
+    """
+    Like grouped_sample, but for items which are themselves counts of units
+    (e.g. vacant units in buildings) - draws counts[g] units from each group
+    g and returns how many were drawn from each item, without ever making
+    one row per unit.
+
+    Parameters
+    ----------
+    groups : array-like
+        The group of each item
+    sizes : array-like
+        The number of units in each item without replacement, or the
+        (non-negative) weight of each item with replacement
+    counts : Series
+        Index is group labels, values are the number of units to draw
+        from that group
+    replace : bool, optional
+        Whether to sample units with replacement (a multinomial draw) or
+        without (a multivariate hypergeometric draw)
+    rng : RandomState, optional
+        Random number generator, defaults to the global numpy one
+
+    Returns
+    -------
+    drawn : ndarray
+        The number of units drawn from each item
+    """
+    groups = np.asarray(groups)
+    sizes = np.asarray(sizes, dtype="float64" if replace else "int64")
+    counts = counts[counts > 0]
+    cnts = counts.values.astype("int64")
+
+    order, starts, ends = _group_slices(groups, counts.index.values)
+    sorted_sizes = sizes[order]
+
+    cumsizes = np.concatenate([[0], np.cumsum(sorted_sizes)])
+    available = cumsizes[ends] - cumsizes[starts]
+    short = available <= 0 if replace else cnts > available
+    if short.any():
+        raise ValueError("Not enough units to draw from in groups: %s" %
+                         counts.index.values[short].tolist())
+
+    drawn = np.zeros(len(groups), dtype="int64")
+    drawn[order] = _split_counts(sorted_sizes, starts, ends, cnts,
+                                 replace, _rng(rng))
+    return drawn
+
+
+def sample_counts(sizes, num, replace=False, rng=None):
+    """
+    Draw num units from items which are counts of units, and return the
+    number of units drawn from each item (see grouped_sample_counts).
+    """
+    sizes = np.asarray(sizes)
+    return grouped_sample_counts(np.zeros(len(sizes), dtype="int64"), sizes,
+                                 pd.Series([num]), replace=replace, rng=rng)
@@ -1,5 +1,6 @@
 import sys
 import time
+import hashlib
 import orca
 import pandas as pd
 import numpy as np
@@ -8,6 +9,8 @@ from urbansim_defaults import utils
 from cStringIO import StringIO
 from urbansim.utils import misc
 from utils import add_buildings
+from feasibility import FeasibilityStore, run_feasibility, \
+    add_feasibility_table, sync_feasibility_store
 
 
 # this method is a custom profit to probability function where we test the
@@ -118,29 +121,17 @@ def lump_sum_accounts(settings, year, buildings, coffer,
                                              metadata=metadata)
 
 
-# this will compute the reduction in revenue from a project due to
-# inclustionary housing - the calculation will be described in thorough
-# comments alongside the code
-def inclusionary_housing_revenue_reduction(feasibility, units):
+# the value of a mortgage of n monthly payments at the given yearly rate -
+# this is the closed form of np.npv(rate / 12, [monthly_payment] * n), which
+# discounts the first payment at t=0
+def mortgage_value(monthly_payment, rate=.055, n=30*12):
+    r = rate / 12.0
+    return monthly_payment * (1 + r) * (1 - (1 + r) ** -n) / r
 
-    print "Computing adjustments due to inclusionary housing"
-
-    # AMI by jurisdiction
-    #
-    # in practice deed restrictions are done by household size but we aren't
-    # going to deed restrict them by household size so it makes sense not to
-    # do that here - if we did this by household size like we do in the real
-    # world we'd need to have a better representation of what household size
-    # is in which unit type
-
-    households = orca.get_table("households")
-    buildings = orca.get_table("buildings")
-    parcels_geography = orca.get_table("parcels_geography")
-    h = orca.merge_tables("households",
-                          [households, buildings, parcels_geography],
-                          columns=["juris_name", "income"])
-    AMI = h.groupby(h.juris_name).income.quantile(.5)
 
+# the value a household at 90% of AMI can afford to buy, by jurisdiction -
+# the calculation is described alongside the code
+def value_can_afford(AMI):
     # per Aksel Olsen (@akselx)
     # take 90% of AMI and multiple by 33% to get the max amount a
     # household can pay per year, divide by 12 to get monthly amt,
@@ -149,159 +140,432 @@ def inclusionary_housing_revenue_reduction(feasibility, units):
     monthly_condo_fee = 250
     monthly_affordable_payment = AMI * .9 * .33 / 12 - monthly_condo_fee
 
-    def value_can_afford(monthly_payment):
-        # this is a 10 year average freddie mac interest rate
-        ten_year_average_interest = .055
-        return np.npv(ten_year_average_interest/12, [monthly_payment]*30*12)
-
-    value_can_afford = {k: value_can_afford(v) for k, v in
-                        monthly_affordable_payment.to_dict().items()}
-    value_can_afford = pd.Series(value_can_afford)
+    # this is a 10 year average freddie mac interest rate
+    value = mortgage_value(monthly_affordable_payment, rate=.055)
 
     # account for interest and property taxes
     interest_and_prop_taxes = .013
-    value_can_afford /= 1+interest_and_prop_taxes
-
-    # there's a lot more nuance to inclusionary percentages than this -
-    # e.g. specific neighborhoods get specific amounts -
-    # http://sf-moh.org/modules/showdocument.aspx?documentid=7253
-
-    pct_inclusionary = orca.get_injectable("inclusionary_housing_settings")
-    juris_name = parcels_geography.juris_name.loc[feasibility.index]
-    pct_affordable = juris_name.map(pct_inclusionary).fillna(0)
-    value_can_afford = juris_name.map(value_can_afford)
-
-    num_affordable_units = (units * pct_affordable).fillna(0).astype("int")
-
-    ave_price_per_unit = \
-        feasibility[('residential', 'building_revenue')] / units
-
-    revenue_diff_per_unit = (ave_price_per_unit - value_can_afford).fillna(0)
-    print "Revenue difference per unit (not zero values)"
-    print revenue_diff_per_unit[revenue_diff_per_unit > 0].describe()
-
-    revenue_reduction = revenue_diff_per_unit * num_affordable_units
-
-    s = num_affordable_units.groupby(parcels_geography.juris_name).sum()
-    print "Feasibile affordable units by jurisdiction"
-    print s[s > 0].order()
-
-    return revenue_reduction, num_affordable_units
-
-
-# this adds fees to the max_profit column of the feasibility dataframe
-# fees are usually spatially specified and are per unit so that calculation
-# is done here as well
-def policy_modifications_of_profit(feasibility, parcels):
-
-    print "Making policy modifications to profitability"
-
-    # this first section adds parcel unit-based fees
-
-    units = feasibility[('residential', 'residential_sqft')] / \
-        parcels.ave_sqft_per_unit
-    fees = (units * parcels.fees_per_unit).fillna(0)
-    print "Sum of residential fees: ", fees.sum()
-
-    feasibility[("residential", "fees")] = fees
-    feasibility[("residential", "max_profit")] -= fees
-
-    #  now non residential fees per sqft
-    for use in ["retail", "office"]:
-
-        if (use, 'non_residential_sqft') not in feasibility.columns:
-            continue
+    return value / (1+interest_and_prop_taxes)
 
-        sqft = feasibility[(use, 'non_residential_sqft')]
-        fees = (sqft * parcels.fees_per_sqft).fillna(0)
-        print "Sum of non-residential fees (%s): %.0f" % (use, fees.sum())
 
-        feasibility[(use, "fees")] = fees
-        feasibility[(use, "max_profit")] -= fees
-
-    # this section adds inclusionary housing reduction in revenue
-    revenue_reduction, num_affordable_units = \
-        inclusionary_housing_revenue_reduction(feasibility, units)
-
-    print "Describe of inclusionary revenue reduction:\n", \
-        revenue_reduction[revenue_reduction > 0].describe()
+class PolicyAdjustments(object):
+    """
+    The policy modifications to profitability - fees, inclusionary housing,
+    SB743, the land value tax and the profitability adjustment policies -
+    for a scenario.  Everything which doesn't change during a run is set up
+    once: the jurisdiction of each parcel, the land value tax bins and the
+    product of the profitability adjustment formulas (which only depend on
+    parcels_geography).  AMI by jurisdiction is only
+    recomputed when the households change.
 
-    print "Describe of number of affordable units:\n", \
-        num_affordable_units[num_affordable_units > 0].describe()
+    Parameters
+    ----------
+    settings : dict
+        Uses acct_settings
+    scenario : str
+        The scenario, to decide which policies are enabled
+    parcels_geography : DataFrame
+        The parcels_geography table, with juris_name and the columns the
+        profitability adjustment formulas use
+    """
+    def __init__(self, settings, scenario, parcels_geography):
+        acct_settings = settings["acct_settings"]
+
+        self.index = parcels_geography.index
+        # the jurisdiction of each parcel is a position in self.juris_names,
+        # and -1 picks the last value of the per jurisdiction arrays, which
+        # is for parcels without a jurisdiction
+        self.juris, self.juris_names = pd.factorize(
+            parcels_geography.juris_name)
+
+        self.vmt_settings = acct_settings.get("vmt_settings", {})
+
+        self.sb743_pcts = None
+        s = acct_settings.get("sb743_settings")
+        if s and s["enable"]:
+            self.sb743_pcts = s["sb743_pcts"]
+
+        self.lvt_breaks = None
+        s = acct_settings.get("land_value_tax_settings")
+        if s and scenario in s["enable_in_scenarios"]:
+            # need to bound the breaks with a reasonable low and high
+            # goalpost - outside of them (and where the ratio is missing)
+            # there's no modification
+            self.lvt_breaks = np.array([-1]+s["bins"]["breaks"]+[2])
+            self.lvt_factors = np.concatenate(
+                [[1.0], np.array(s["bins"]["pcts"]) + 1, [1.0]])
+
+        self.formulas = []
+        for policy in \
+                acct_settings.get("profitability_adjustment_policies",
+                                  {}).values():
+            if scenario in policy["enable_in_scenarios"]:
+                self.formulas.append(
+                    (policy["name"],
+                     policy["profitability_adjustment_formula"]))
+
+        self.custom_factors = self._custom_factors(parcels_geography)
+
+        self._ami_key = None
+        self._value_can_afford = None
+
+    def _custom_factors(self, parcels_geography):
+        factors = np.ones(len(self.index))
+        for name, formula in self.formulas:
+            # always with pandas' parser - python binds & and | tighter than
+            # comparisons, so evaluating the formulas over numpy arrays could
+            # silently give a different result
+            pct = parcels_geography.eval(formula).values
+            pct = np.asarray(pct, dtype="float64") + 1.0
+
+            print "Modifying profit for %s:\n" % name, \
+                pd.Series(pct).describe()
+
+            factors *= pct
+        return factors
+
+    def positions(self, index):
+        return self.index.get_indexer(index)
+
+    # the position of each parcel's jurisdiction in juris_names, -1 where
+    # it doesn't have one
+    def jurisdictions(self, pos):
+        return np.where(pos >= 0, self.juris[pos], -1)
 
-    feasibility[("residential", "policy_based_revenue_reduction")] = \
-        revenue_reduction
-    feasibility[("residential", "max_profit")] -= revenue_reduction
-    feasibility[("residential", "deed_restricted_units")] = \
-        num_affordable_units
-    feasibility[("residential", "inclusionary_units")] = \
-        num_affordable_units
+    # AMI by jurisdiction
+    #
+    # in practice deed restrictions are done by household size but we aren't
+    # going to deed restrict them by household size so it makes sense not to
+    # do that here - if we did this by household size like we do in the real
+    # world we'd need to have a better representation of what household size
+    # is in which unit type
+    def affordable_values(self):
+        """
+        The value a household can afford by jurisdiction, as an array over
+        juris_names with NaN at the end.  It is recomputed only if the
+        households (their buildings or incomes) changed since last time.
+        """
+        households = orca.get_table("households")
+        building_id = households.building_id.values
+        income = households.income.values
+        key = (len(building_id),
+               hashlib.md5(building_id.tobytes()).hexdigest(),
+               hashlib.md5(income.tobytes()).hexdigest())
+
+        if key != self._ami_key:
+            h = orca.merge_tables("households",
+                                  [households, orca.get_table("buildings"),
+                                   orca.get_table("parcels_geography")],
+                                  columns=["juris_name", "income"])
+            AMI = h.groupby(h.juris_name).income.quantile(.5)
+
+            self._value_can_afford = np.append(
+                value_can_afford(AMI).reindex(self.juris_names).values,
+                np.nan)
+            self._ami_key = key
+
+        return self._value_can_afford
+
+    # the pcts by jurisdiction (or one pct for all of them) as an array
+    # over juris_names, with 0 for parcels without a jurisdiction
+    def juris_table(self, pcts):
+        if np.isscalar(pcts):
+            return np.append(np.repeat(float(pcts), len(self.juris_names)), 0)
+        return np.append(pd.Series(pcts, dtype="float64").
+                         reindex(self.juris_names).fillna(0).values, 0)
+
+    def inclusionary(self, pos, units, building_revenue, pct_inclusionary):
+        """
+        The reduction in revenue from inclusionary housing and the number
+        of affordable units for the parcels at pos, given the units and
+        the revenue of the residential projects on them and a list of
+        inclusionary pcts by jurisdiction - both are parcels x pcts arrays
+        (a column for each set of pcts).
+        """
+        # there's a lot more nuance to inclusionary percentages than this -
+        # e.g. specific neighborhoods get specific amounts -
+        # http://sf-moh.org/modules/showdocument.aspx?documentid=7253
+        juris = self.jurisdictions(pos)
+        pct_affordable = np.column_stack(
+            [self.juris_table(pcts)[juris] for pcts in pct_inclusionary])
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            num_affordable_units = units[:, np.newaxis] * pct_affordable
+            num_affordable_units[np.isnan(num_affordable_units)] = 0
+            num_affordable_units = num_affordable_units.astype("int")
+
+            revenue_diff_per_unit = building_revenue / units - \
+                self.affordable_values()[juris]
+            revenue_diff_per_unit[np.isnan(revenue_diff_per_unit)] = 0
+
+            revenue_reduction = revenue_diff_per_unit[:, np.newaxis] * \
+                num_affordable_units
+
+        return revenue_reduction, num_affordable_units
+
+    def sb743(self, vmt_res_cat, sb743_pcts=None):
+        sb743_pcts = sb743_pcts if sb743_pcts is not None else \
+            self.sb743_pcts
+        return pd.Series(vmt_res_cat).map(sb743_pcts).values + 1
+
+    # the land value tax modification, from the bin each parcel's zoned
+    # build ratio falls in
+    def land_value_tax(self, index):
+        pzc = orca.get_table("parcels_zoning_calculations")
+        ratio = pzc.zoned_build_ratio.reindex(index).values
+        factors = self.lvt_factors[
+            np.digitize(ratio, self.lvt_breaks, right=True)]
+        # parcels which aren't in the table at all are missing
+        factors[~index.isin(pzc.index)] = np.nan
+        return factors
+
+    # the max_profit of a form before any policy modifications, which apply
+    # keeps so the modifications can be made again with other parameters
+    def base_profit(self, feasibility, form):
+        if feasibility.has_column(form, "unadjusted_max_profit"):
+            return feasibility.column(form, "unadjusted_max_profit")
+        return feasibility.column(form, "max_profit")
+
+    def vmt_fees(self, vmt_res_cat, *fee_amounts):
+        """
+        The sum of the fee amounts by vmt category of each parcel - missing
+        where any of them doesn't have an amount for the parcel's category,
+        like the vmt_res_fees and vmt_com_fees parcel columns.
+        """
+        vmt_res_cat = pd.Series(vmt_res_cat)
+        fees = 0
+        for amounts in fee_amounts:
+            fees = fees + vmt_res_cat.map(amounts).values
+        return fees
+
+    def adjust(self, feasibility, parcels, policies):
+        """
+        Compute the policy modifications to the profitability of a
+        FeasibilityStore for a list of policies, without changing it.
+
+        Parameters
+        ----------
+        feasibility : FeasibilityStore
+        parcels : DataFrameWrapper
+        policies : list of dict
+            The policy parameters to use instead of the ones in the
+            settings (see policy_sweep) - an empty dict is the settings as
+            they are.  The VMT fee amounts are applied whatever
+            the scenario.
+
+        Returns
+        -------
+        adjustments : dict
+            The residential units, and parcels x policies arrays of the
+            residential fees, revenue_reduction, affordable_units and
+            max_profit, and the fees and max_profit of the non residential
+            forms keyed by (form, name)
+        """
+        index = feasibility.index
+        pos = self.positions(index)
+        vmt_res_cat = parcels.vmt_res_cat.reindex(index).values
+        d = {}
+
+        #  non residential fees per sqft
+        base = parcels.fees_per_sqft.reindex(index).values
+        com_for_com = self.vmt_settings.get("com_for_com_fee_amounts", {})
+        for use in ["retail", "office"]:
+
+            if not feasibility.has_column(use, 'non_residential_sqft'):
+                continue
 
-    settings = orca.get_injectable("settings")
+            sqft = feasibility.column(use, 'non_residential_sqft')
+            fees = np.nan_to_num(sqft[:, np.newaxis] * np.column_stack([
+                self.vmt_fees(vmt_res_cat, p["com_for_res_fee_amounts"],
+                              com_for_com)
+                if "com_for_res_fee_amounts" in p else base
+                for p in policies]))
+
+            d[(use, "fees")] = fees
+            d[(use, "max_profit")] = \
+                self.base_profit(feasibility, use)[:, np.newaxis] - fees
+
+        # parcel unit-based fees
+        base = parcels.fees_per_unit.reindex(index).values
+        with np.errstate(invalid="ignore", divide="ignore"):
+            units = feasibility.column('residential', 'residential_sqft') / \
+                parcels.ave_sqft_per_unit.reindex(index).values
+            fees = units[:, np.newaxis] * np.column_stack([
+                self.vmt_fees(vmt_res_cat, p["res_for_res_fee_amounts"])
+                if "res_for_res_fee_amounts" in p else base
+                for p in policies])
+        fees[np.isnan(fees)] = 0
+
+        # inclusionary housing reduction in revenue
+        pct_inclusionary = orca.get_injectable("inclusionary_housing_settings")
+        revenue_reduction, num_affordable_units = self.inclusionary(
+            pos, units, feasibility.column('residential', 'building_revenue'),
+            [p.get("inclusionary_pcts", pct_inclusionary) for p in policies])
+
+        # all the pct modifications multiply
+        factors = self.custom_factors[pos]
+        if self.formulas:
+            factors[pos < 0] = np.nan
+        if self.lvt_breaks is not None:
+            factors *= self.land_value_tax(index)
+        factors = np.tile(factors[:, np.newaxis], (1, len(policies)))
+        for k, p in enumerate(policies):
+            sb743_pcts = p.get("sb743_pcts", self.sb743_pcts)
+            if sb743_pcts is not None:
+                factors[:, k] *= self.sb743(
+                    feasibility.column("residential", "vmt_res_cat"),
+                    sb743_pcts)
+
+        d["units"] = units
+        d["fees"] = fees
+        d["revenue_reduction"] = revenue_reduction
+        d["affordable_units"] = num_affordable_units
+        base = self.base_profit(feasibility, "residential")
+        d["max_profit"] = \
+            (base[:, np.newaxis] - fees - revenue_reduction) * factors
+        return d
+
+    def _update(self, feasibility, form, fees, max_profit):
+        if not feasibility.has_column(form, "unadjusted_max_profit"):
+            feasibility.add_column(form, "unadjusted_max_profit",
+                                   feasibility.column(form, "max_profit"))
+        feasibility.add_column(form, "fees", fees)
+        feasibility.column(form, "max_profit")[:] = max_profit
+
+    def apply(self, feasibility, parcels):
+        """
+        Make the policy modifications to the profitability of a
+        FeasibilityStore in place - the fees, inclusionary housing revenue
+        reduction and affordable units are added as columns, max_profit is
+        updated once and the max_profit before the modifications is kept
+        as unadjusted_max_profit.
+        """
+        print "Making policy modifications to profitability"
+
+        d = self.adjust(feasibility, parcels, [{}])
+
+        for use in ["retail", "office"]:
+
+            if (use, "max_profit") not in d:
+                continue
 
-    if "sb743_settings" in settings["acct_settings"]:
+            fees = d[(use, "fees")][:, 0]
+            print "Sum of non-residential fees (%s): %.0f" % \
+                (use, fees.sum())
+            self._update(feasibility, use, fees, d[(use, "max_profit")][:, 0])
 
-        sb743_settings = settings["acct_settings"]["sb743_settings"]
+        fees = d["fees"][:, 0]
+        print "Sum of residential fees: ", fees.sum()
+        self._update(feasibility, "residential", fees, d["max_profit"][:, 0])
 
-        if sb743_settings["enable"]:
+        num_affordable_units = d["affordable_units"][:, 0]
 
-            pct_modifications = feasibility[("residential", "vmt_res_cat")].\
-                map(sb743_settings["sb743_pcts"]) + 1
+        juris = self.jurisdictions(self.positions(feasibility.index))
+        s = pd.Series(np.bincount(
+            juris[juris >= 0], weights=num_affordable_units[juris >= 0],
+            minlength=len(self.juris_names)), index=self.juris_names)
+        print "Feasibile affordable units by jurisdiction"
+        print s[s > 0].order()
 
-            print "Modifying profit for SB743:\n", pct_modifications.describe()
+        feasibility.add_column("residential", "policy_based_revenue_reduction",
+                               d["revenue_reduction"][:, 0])
+        feasibility.add_column("residential", "deed_restricted_units",
+                               num_affordable_units)
+        feasibility.add_column("residential", "inclusionary_units",
+                               num_affordable_units)
 
-            feasibility[("residential", "max_profit")] *= pct_modifications
+        print "There are %d affordable units if all feasible projects " \
+            "are built" % num_affordable_units.sum()
 
-    if "land_value_tax_settings" in settings["acct_settings"]:
+        return feasibility
 
-        s = settings["acct_settings"]["land_value_tax_settings"]
 
-        if orca.get_injectable("scenario") in s["enable_in_scenarios"]:
+@orca.injectable("policy_adjustments", cache=True)
+def policy_adjustments(settings, scenario, parcels_geography):
+    return PolicyAdjustments(settings, scenario, parcels_geography.local)
 
-            bins = s["bins"]
-            pcts = bins["pcts"]
-            # need to boud the breaks with a reasonable low and high goalpost
-            breaks = [-1]+bins["breaks"]+[2]
 
-            pzc = orca.get_table("parcels_zoning_calculations")
-            s = pzc.zoned_build_ratio
-            # map the breakpoints defined in yaml to the pcts defined there
-            pct_modifications = pd.cut(s, breaks, labels=pcts).\
-                astype('float') + 1
-            # if some parcels got skipped, fill them in with no modification
-            pct_modifications = \
-                pct_modifications.reindex(pzc.index).fillna(1.0)
+# this adds fees to the max_profit column of the feasibility store
+# fees are usually spatially specified and are per unit so that calculation
+# is done here as well - see PolicyAdjustments
+def policy_modifications_of_profit(feasibility, parcels):
+    return orca.get_injectable("policy_adjustments").apply(
+        feasibility, parcels)
 
-            print "Modifying profit for Land Value Tax:\n", \
-                pct_modifications.describe()
 
-            feasibility[("residential", "max_profit")] *= pct_modifications
+def policy_sweep(feasibility, parcels, policies):
+    """
+    Screen a list of policies on one feasibility, without running the
+    simulation for each - the policy modifications to profitability are
+    made for all of them at once.
 
-    if "profitability_adjustment_policies" in settings["acct_settings"]:
+    Parameters
+    ----------
+    feasibility : FeasibilityStore or DataFrame
+        The feasibility (the store or the wide feasibility table), with or
+        without the policy modifications of the scenario made already
+    parcels : DataFrameWrapper
+    policies : list of dict
+        The parameters of each policy - a name and any of
+        inclusionary_pcts (a pct by jurisdiction, or one pct for all),
+        res_for_res_fee_amounts, com_for_res_fee_amounts (fees by vmt
+        category) and sb743_pcts.  The parameters which aren't given are
+        the ones in the settings.
 
-        for key, policy in \
-                settings["acct_settings"][
-                    "profitability_adjustment_policies"].items():
+    Returns
+    -------
+    parcels, juris : DataFrames
+        The residential max_profit, feasible_units and affordable_units
+        (feasible units are the units of projects with a positive
+        max_profit) of every parcel for each policy, with (measure, policy
+        name) columns, and the feasible and affordable units summed by
+        jurisdiction
+    """
+    if isinstance(feasibility, pd.DataFrame):
+        feasibility = FeasibilityStore.from_frame(feasibility)
+    names = [p.get("name", str(k)) for k, p in enumerate(policies)]
+
+    adjustments = orca.get_injectable("policy_adjustments")
+    d = adjustments.adjust(feasibility, parcels, policies)
+
+    feasible = d["max_profit"] > 0
+    units = np.nan_to_num(d["units"])[:, np.newaxis]
+    measures = [
+        ("max_profit", d["max_profit"]),
+        ("feasible_units", np.where(feasible, units, 0)),
+        ("affordable_units", np.where(feasible, d["affordable_units"], 0))
+    ]
+    for use in ["retail", "office"]:
+        if (use, "max_profit") in d:
+            measures.append(("%s_max_profit" % use, d[(use, "max_profit")]))
 
-            if orca.get_injectable("scenario") in \
-                    policy["enable_in_scenarios"]:
+    df = pd.concat([pd.DataFrame(values, index=feasibility.index,
+                                 columns=names)
+                    for _, values in measures],
+                   axis=1, keys=[measure for measure, _ in measures])
 
-                parcels_geography = orca.get_table("parcels_geography")
+    # -1 picks the missing name at the end
+    juris = adjustments.jurisdictions(
+        adjustments.positions(feasibility.index))
+    juris = pd.Series(np.append(np.asarray(adjustments.juris_names,
+                                           dtype="object"), np.nan)[juris],
+                      index=feasibility.index)
 
-                pct_modifications = \
-                    parcels_geography.local.eval(
-                        policy["profitability_adjustment_formula"])
-                pct_modifications += 1.0
+    return df, df[["feasible_units", "affordable_units"]].groupby(juris).sum()
 
-                print "Modifying profit for %s:\n" % policy["name"], \
-                    pct_modifications.describe()
 
-                feasibility[("residential", "max_profit")] *= pct_modifications
+# writes the parcel and juris results of a policy sweep (see policy_sweep)
+# to one compressed h5 file with the keys "parcels" and "juris"
+def write_policy_sweep(fname, feasibility, parcels, policies):
+    df, juris = policy_sweep(feasibility, parcels, policies)
 
-    print "There are %d affordable units if all feasible projects are built" %\
-        feasibility[("residential", "deed_restricted_units")].sum()
+    store = pd.HDFStore(fname, "w", complevel=9, complib="zlib")
+    store.put("parcels", df)
+    store.put("juris", juris)
+    store.close()
 
-    return feasibility
+    print "Wrote the sweep of policies %s to %s" % \
+        (", ".join(df["max_profit"].columns), fname)
 
 
 @orca.step("calculate_vmt_fees")
@@ -366,16 +630,16 @@ def calculate_vmt_fees(settings, year, buildings, vmt_fee_categories, coffer,
 
 
 @orca.step()
-def subsidized_office_developer(feasibility, coffer, acct_settings, year,
-                                add_extra_columns_func, buildings, summary):
+def subsidized_office_developer(feasibility_store, coffer, acct_settings,
+                                year, add_extra_columns_func, buildings,
+                                summary):
 
     # get the total subsidy for subsidizing office
     total_subsidy = coffer["vmt_com_acct"].\
         total_transactions_by_subacct("regional")
 
     # get the office feasibility frame and sort by profit per sqft
-    feasibility = feasibility.to_frame().loc[:, "office"]
-    feasibility = feasibility.dropna(subset=["max_profit"])
+    feasibility = feasibility_store.feasible("office")
 
     feasibility["pda_id"] = feasibility.pda
 
@@ -669,6 +933,8 @@ def run_subsidized_developer(feasibility, parcels, buildings, households,
 
         new_buildings_list.append(new_buildings)
 
+    sync_feasibility_store()
+
     total_len = reduce(lambda x, y: x+len(y), new_buildings_list, 0)
     if total_len == 0:
         print "No subsidized buildings"
@@ -697,26 +963,23 @@ def subsidized_residential_feasibility(
     kwargs["only_built"] = False
     kwargs["forms_to_test"] = ["residential"]
     # step 1
-    utils.run_feasibility(parcels,
-                          parcel_sales_price_sqft_func,
-                          parcel_is_allowed_func,
-                          **kwargs)
-
-    feasibility = orca.get_table("feasibility").to_frame()
-    # get rid of the multiindex that comes back from feasibility
-    feasibility = feasibility.stack(level=0).reset_index(level=1, drop=True)
-    # join to parcels_geography for filtering
-    feasibility = feasibility.join(parcels_geography.to_frame())
+    feasibility = run_feasibility(parcels,
+                                  parcel_sales_price_sqft_func,
+                                  parcel_is_allowed_func,
+                                  cache_name="subsidized_residential",
+                                  **kwargs)
 
-    # add the multiindex back
-    feasibility.columns = pd.MultiIndex.from_tuples(
-            [("residential", col) for col in feasibility.columns])
+    # join to parcels_geography for filtering
+    pg = parcels_geography.to_frame().reindex(feasibility.index)
+    for col in pg.columns:
+        if not feasibility.has_column("residential", col):
+            feasibility.add_column("residential", col, pg[col].values)
 
-    feasibility = policy_modifications_of_profit(feasibility, parcels)
+    policy_modifications_of_profit(feasibility, parcels)
 
-    orca.add_table("feasibility", feasibility)
+    add_feasibility_table(feasibility)
 
-    df = orca.get_table("feasibility").to_frame()
+    df = feasibility.to_frame()
     df = df.stack(level=0).reset_index(level=1, drop=True)
     df.to_csv("runs/run{}_feasibility_{}.csv".format(
         orca.get_injectable("run_number"),
@@ -727,12 +990,9 @@ def subsidized_residential_feasibility(
 def subsidized_residential_developer_vmt(
         households, buildings, add_extra_columns_func,
         parcels_geography, year, acct_settings, parcels,
-        settings, summary, coffer, form_to_btype_func, feasibility):
-
-    feasibility = feasibility.to_frame()
-    feasibility = feasibility.stack(level=0).reset_index(level=1, drop=True)
+        settings, summary, coffer, form_to_btype_func, feasibility_store):
 
-    run_subsidized_developer(feasibility,
+    run_subsidized_developer(feasibility_store.feasible("residential"),
                              parcels,
                              buildings,
                              households,
@@ -766,9 +1026,8 @@ def subsidized_residential_developer_lump_sum_accts(
         # results - this is not ideal and is a story to fix in pivotal, but the
         # only cost is in time - the results should be the same
         orca.eval_step("subsidized_residential_feasibility")
-        feasibility = orca.get_table("feasibility").to_frame()
-        feasibility = feasibility.stack(level=0).\
-            reset_index(level=1, drop=True)
+        feasibility = orca.get_injectable("feasibility_store").\
+            feasible("residential")
 
         run_subsidized_developer(feasibility,
                                  parcels,
@@ -787,5 +1046,5 @@ def subsidized_residential_developer_lump_sum_accts(
 
         buildings = orca.get_table("buildings")
 
-        # set to an empty dataframe to save memory
-        orca.add_table("feasibility", pd.DataFrame())
+        # set to an empty store to save memory
+        add_feasibility_table(FeasibilityStore(parcels.index[:0]))
@@ -3,8 +3,8 @@ import os
 import orca
 import pandas as pd
 import numpy as np
-from utils import random_indexes, round_series_match_target,\
-    scale_by_target, simple_ipf
+from utils import random_indexes, scale_by_target
+import balancing
 from urbansim.utils import misc
 from scripts.output_csv_utils import format_df
 
@@ -746,7 +746,9 @@ def add_population(df, year):
 
     s = scale_by_target(s, target, .15)
 
-    df["hhpop"] = round_series_match_target(s, target, 0)
+    df["hhpop"] = pd.Series(
+        balancing.integerize(s.values.reshape(1, -1), [target])[0],
+        index=s.index)
     df["hhpop"] = df.hhpop.fillna(0)
     return df
 
@@ -779,7 +781,9 @@ def add_employment(df, year):
 
     empres = scale_by_target(empres, target)
 
-    df["empres"] = round_series_match_target(empres, target, 0)
+    df["empres"] = pd.Series(
+        balancing.integerize(empres.values.reshape(1, -1), [target])[0],
+        index=empres.index)
 
     # this should really make the assertion below pass, but this now
     # only occurs very infrequently
@@ -811,16 +815,15 @@ def add_age_categories(df, year):
     seed_matrix[seed_matrix == 0] = .1
     seed_matrix[row_marginals == 0, :] = 0
 
-    mat = simple_ipf(seed_matrix, col_marginals, row_marginals)
-    agedf = pd.DataFrame(mat)
+    mat, residuals = balancing.ipf(
+        seed_matrix, [((1,), col_marginals), ((0,), row_marginals)])
+    print "Age category IPF converged to %.2f after %d iterations" % \
+        (residuals[-1], len(residuals))
+    # round every zone to whole people which add up to its population
+    agedf = pd.DataFrame(balancing.integerize(mat, row_marginals))
     agedf.columns = [col.upper() for col in agecols]
     agedf.index = zfi.index
 
-    for ind, row in agedf.iterrows():
-        target = df.totpop.loc[ind]
-        row = row.round()
-        agedf.loc[ind] = round_series_match_target(row, target, 0)
-
     for col in agedf.columns:
         df[col] = agedf[col]
 
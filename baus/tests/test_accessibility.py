@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+from collections import OrderedDict
+from scipy.sparse.csgraph import dijkstra
+
+from baus import accessibility
+
+
+# 11 nodes on a line, 10 apart
+def line_network():
+    node_id = np.arange(100, 111)
+    return {
+        "node_id": node_id,
+        "x": np.arange(11) * 10.0,
+        "y": np.zeros(11),
+        "from": node_id[:-1],
+        "to": node_id[1:],
+        "weight": np.repeat(10.0, 10)
+    }
+
+
+def test_nearest_poi_distances():
+    pois = OrderedDict([
+        ("bart", (np.array([10.0, 90.0]), np.array([0.0, 0.0]))),
+        ("landmark", (np.array([0.0]), np.array([0.0])))
+    ])
+
+    d = accessibility.nearest_poi_distances(line_network(), pois, 1000)
+
+    assert list(d.columns) == ["bart", "landmark"]
+    assert list(d.index) == list(range(100, 111))
+    np.testing.assert_allclose(
+        d.bart.values, [10, 0, 10, 20, 30, 40, 30, 20, 10, 0, 10], atol=1e-6)
+    # a path can't shortcut between the bart stations through the
+    # virtual node
+    np.testing.assert_allclose(
+        d.landmark.values, np.arange(11) * 10.0, atol=1e-6)
+
+
+def test_nearest_poi_distances_max_dist():
+    pois = {"landmark": (np.array([0.0]), np.array([0.0]))}
+
+    d = accessibility.nearest_poi_distances(line_network(), pois, 25)
+
+    np.testing.assert_allclose(
+        d.landmark.values, [0, 10, 20] + [25] * 8, atol=1e-6)
+
+
+class Net(object):
+    def __init__(self, graph_arrays, twoway):
+        self.graph_arrays = graph_arrays
+        self.twoway = twoway
+
+
+def random_network(n=60, seed=0):
+    rng = np.random.RandomState(seed)
+    x, y = rng.uniform(0, 100, n), rng.uniform(0, 100, n)
+    frm = np.concatenate([np.arange(n), rng.randint(0, n, 3 * n)])
+    to = np.concatenate([np.roll(np.arange(n), 1), rng.randint(0, n, 3 * n)])
+    keep = frm != to
+    node_id = np.arange(n) + 1000
+    return {
+        "node_id": node_id,
+        "x": x,
+        "y": y,
+        "from": node_id[frm[keep]],
+        "to": node_id[to[keep]],
+        "weight": np.hypot(x[frm] - x[to], y[frm] - y[to])[keep]
+    }
+
+
+# what pandana would aggregate at every node - the amounts at the nodes
+# within radius of it, searching from the node along the edges
+def brute_force(a, twoway, sources, amounts, decay, radius):
+    graph = accessibility.graph_from_arrays(a)
+    d = dijkstra(graph, directed=not twoway)[:, sources]
+    w = np.where(d <= radius,
+                 accessibility.DECAY_WEIGHTS[decay](np.minimum(d, radius),
+                                                    radius), 0)
+    return w.dot(amounts)
+
+
+@pytest.mark.parametrize("twoway", [True, False])
+@pytest.mark.parametrize("max_cells", [accessibility.MAX_SEARCH_CELLS, 40])
+def test_spread(twoway, max_cells):
+    a = random_network()
+    rng = np.random.RandomState(1)
+    sources = np.sort(rng.choice(60, 15, replace=False))
+    amounts = rng.uniform(-5, 5, 15)
+
+    out = accessibility.spread(
+        Net(a, twoway), sources,
+        [(amounts, "flat"), (amounts, "linear"), (amounts, "exp")], 40.0,
+        max_cells=max_cells)
+
+    for o, decay in zip(out, ["flat", "linear", "exp"]):
+        np.testing.assert_allclose(
+            o, brute_force(a, twoway, sources, amounts, decay, 40.0),
+            atol=1e-9)
+
+
+def test_trim_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(accessibility, "cache_dir", lambda: str(tmpdir))
+    for i, name in enumerate(["a", "b", "c"]):
+        f = tmpdir.join(name + ".h5")
+        f.write("x" * 400 * 1024)
+        f.setmtime(1000 + i)
+    # the least recently used file is the one which was read last
+    tmpdir.join("a.h5").setmtime(2000)
+
+    accessibility._trim_cache(1)
+
+    assert sorted(f.basename for f in tmpdir.listdir()) == ["a.h5", "c.h5"]
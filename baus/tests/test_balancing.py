@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+
+from baus import balancing
+
+
+def test_ipf_matches_marginals():
+    rng = np.random.RandomState(0)
+    seed = rng.uniform(1, 10, (5, 4))
+    rows = np.array([10., 20., 30., 40., 50.])
+    cols = np.array([60., 40., 30., 20.])
+
+    out, residuals = balancing.ipf(seed, [((0,), rows), ((1,), cols)],
+                                   tolerance=1e-6, max_iterations=1000)
+
+    # balanced in place
+    assert out is seed
+    np.testing.assert_allclose(out.sum(axis=1), rows, atol=1e-6)
+    np.testing.assert_allclose(out.sum(axis=0), cols, atol=1e-6)
+    assert residuals[-1] < 1e-6
+    assert (np.diff(residuals) <= 1e-9).all()
+
+
+def test_ipf_stacked():
+    rng = np.random.RandomState(1)
+    seed = rng.uniform(1, 10, (3, 2, 4))
+    row_totals = rng.uniform(10, 20, (3, 2))
+    # every matrix in the stack has its own column totals, which add up to
+    # the same total as its row totals
+    col_totals = rng.uniform(1, 2, (3, 4))
+    col_totals *= (row_totals.sum(axis=1) / col_totals.sum(axis=1))[:, None]
+
+    out, _ = balancing.ipf(seed, [((0, 1), row_totals),
+                                  ((0, 2), col_totals)],
+                           tolerance=1e-6, max_iterations=1000)
+
+    np.testing.assert_allclose(out.sum(axis=2), row_totals, atol=1e-6)
+    np.testing.assert_allclose(out.sum(axis=1), col_totals, atol=1e-6)
+
+
+def test_ipf_zero_rows():
+    seed = np.array([[1., 1.], [0., 0.], [1., 3.]])
+    rows = np.array([0., 5., 8.])
+    cols = np.array([3., 5.])
+
+    out, residuals = balancing.ipf(seed, [((0,), rows), ((1,), cols)],
+                                   max_iterations=20)
+
+    # a zero target zeroes the row, and a row of zeros stays zero
+    np.testing.assert_array_equal(out[0], 0)
+    np.testing.assert_array_equal(out[1], 0)
+    assert np.isfinite(out).all()
+    # the row with a target but no seed can never be matched
+    assert residuals[-1] >= 5 - 1e-9
+    assert len(residuals) == 20
+
+
+def test_integerize_row_totals():
+    rng = np.random.RandomState(0)
+    mat = rng.uniform(0, 10, (50, 6))
+    mat[3] = 0
+    mat[7, 2] = np.nan
+    row_totals = rng.randint(0, 100, 50)
+
+    result = balancing.integerize(mat, row_totals, rng=rng)
+
+    assert result.dtype.kind == "i"
+    assert (result >= 0).all()
+    # a row without values stays zeros, every other row meets its total
+    np.testing.assert_array_equal(result[3], 0)
+    expected = row_totals.copy()
+    expected[3] = 0
+    np.testing.assert_array_equal(result.sum(axis=1), expected)
+
+    # every cell is the floor or the ceiling of its scaled value
+    scaled = np.nan_to_num(mat)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scaled = scaled * np.nan_to_num(
+            expected / scaled.sum(axis=1))[:, None]
+    assert (result >= np.floor(scaled) - 1e-9).all()
+    assert (result <= np.ceil(scaled) + 1e-9).all()
+
+
+def test_integerize_column_totals():
+    rng = np.random.RandomState(2)
+    mat = rng.uniform(0, 10, (30, 5))
+    row_totals = rng.randint(1, 50, 30)
+    col_totals = np.bincount(rng.randint(0, 5, row_totals.sum()),
+                             minlength=5)
+
+    result = balancing.integerize(mat, row_totals, col_totals, rng=rng)
+
+    assert (result >= 0).all()
+    np.testing.assert_array_equal(result.sum(axis=1), row_totals)
+    np.testing.assert_array_equal(result.sum(axis=0), col_totals)
+
+
+def test_integerize_expected_values():
+    mat = np.array([[0.5, 1.25, 2.25]])
+    rng = np.random.RandomState(3)
+
+    draws = np.array([balancing.integerize(mat, [4], rng=rng)[0]
+                      for _ in range(4000)])
+
+    np.testing.assert_allclose(draws.mean(axis=0), mat[0], atol=.05)
+
+
+def test_integerize_errors():
+    mat = np.array([[1., 1.], [2., 2.]])
+
+    with pytest.raises(ValueError):
+        balancing.integerize(mat, [2, 4], [3, 2])
+
+    # no moves between columns can meet a negative total
+    with pytest.raises(ValueError):
+        balancing.integerize(np.array([[1., 0.]]), [1], [2, -1])
+
+
+def test_integerize_reproducible():
+    mat = np.random.RandomState(4).uniform(0, 10, (20, 4))
+    row_totals = np.arange(20) * 3
+
+    a = balancing.integerize(mat, row_totals, rng=np.random.RandomState(5))
+    b = balancing.integerize(mat, row_totals, rng=np.random.RandomState(5))
+
+    np.testing.assert_array_equal(a, b)
@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from baus.feasibility import FeasibilityStore, config_key
+
+
+def frames():
+    residential = pd.DataFrame({
+        "max_profit": [1., np.nan, -3.],
+        "residential_sqft": [1000., np.nan, 3000.],
+        "juris": ["a", "b", "c"]
+    }, index=[10, 11, 12], columns=["max_profit", "residential_sqft",
+                                    "juris"])
+    office = pd.DataFrame({
+        "max_profit": [5.],
+        "non_residential_sqft": [2000.]
+    }, index=[11], columns=["max_profit", "non_residential_sqft"])
+    return {"residential": residential, "office": office}
+
+
+def test_store_round_trip():
+    store = FeasibilityStore.from_frames(frames(),
+                                         forms=["residential", "office"])
+
+    df = store.to_frame()
+    assert list(df.index) == [10, 11, 12]
+    assert list(df.columns) == [
+        ("residential", "max_profit"), ("residential", "residential_sqft"),
+        ("residential", "juris"), ("office", "max_profit"),
+        ("office", "non_residential_sqft")]
+    np.testing.assert_array_equal(df["office"].max_profit, [np.nan, 5, np.nan])
+
+    again = FeasibilityStore.from_frame(df).to_frame()
+    pd.testing.assert_frame_equal(again, df)
+
+
+def test_store_float32():
+    store = FeasibilityStore.from_frames(frames(),
+                                         forms=["residential", "office"],
+                                         dtype="float32")
+
+    assert store.column("residential", "max_profit").dtype == np.float32
+    assert store.view("office").max_profit.dtype == np.float32
+    store.add_column("office", "fees", np.array([1., 2., 3.]))
+    assert store.column("office", "fees").dtype == np.float32
+    np.testing.assert_array_equal(
+        store.column("residential", "residential_sqft"), [1000, np.nan, 3000])
+
+
+def test_store_updates_in_place():
+    store = FeasibilityStore.from_frames(frames(),
+                                         forms=["residential", "office"])
+
+    store.column("residential", "max_profit")[:] += 1
+    np.testing.assert_array_equal(store.view("residential").max_profit,
+                                  [2, np.nan, -2])
+    np.testing.assert_array_equal(store.to_frame()["residential"].max_profit,
+                                  [2, np.nan, -2])
+
+
+def test_store_grow_invalidates_columns():
+    store = FeasibilityStore.from_frames(frames(),
+                                         forms=["residential", "office"])
+    profit = store.column("residential", "max_profit")
+
+    for i in range(FeasibilityStore.SPARE_COLUMNS + 1):
+        store.add_column("residential", "fee_%d" % i, np.zeros(3))
+
+    # the block moved, so writing to the old view would be lost
+    with pytest.raises(ValueError):
+        profit[:] = 0
+
+    store.column("residential", "max_profit")[:] = 0
+    np.testing.assert_array_equal(store.view("residential").max_profit, 0)
+    assert store.columns("residential")[:3] == [
+        "max_profit", "residential_sqft", "juris"]
+
+
+def test_store_feasible():
+    store = FeasibilityStore.from_frames(frames(),
+                                         forms=["residential", "office"])
+
+    df = store.feasible("residential")
+    assert list(df.index) == [10, 12]
+    assert list(df.columns) == ["max_profit", "residential_sqft", "juris"]
+
+    # it's a copy, not a view into the store
+    df["max_profit"] = 0
+    np.testing.assert_array_equal(store.column("residential", "max_profit"),
+                                  [1, np.nan, -3])
+
+    assert list(store.feasible("office").index) == [11]
+
+
+def test_empty_store():
+    store = FeasibilityStore(pd.Index([]))
+    assert len(store.to_frame()) == 0
+
+
+class Config(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def test_config_key():
+    fars = np.arange(2000) * .1
+    key = config_key(Config(fars=fars, costs={"office": np.array([1., 2.])}))
+
+    # numpy's repr would print both of these the same way
+    other = fars.copy()
+    other[1000] += 1
+    assert config_key(Config(fars=other,
+                             costs={"office": np.array([1., 2.])})) != key
+    assert config_key(Config(
+        fars=fars, costs={"office": np.array([1., 2.000000001])})) != key
+
+    assert config_key(Config(fars=fars.copy(),
+                             costs={"office": np.array([1., 2.])})) == key
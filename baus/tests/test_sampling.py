@@ -0,0 +1,186 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from baus import sampling
+
+
+GROUPS = np.array(["a", "b", "a", "c", "b", "a", "c", "a"])
+
+
+def test_grouped_weighted_sample_counts():
+    weights = np.array([1, 2, 0, 1, 1, 3, 5, 0], dtype="float64")
+    counts = pd.Series([50, 0, 30], index=["a", "b", "c"])
+
+    pos = sampling.grouped_weighted_sample(
+        GROUPS, weights, counts, rng=np.random.RandomState(0))
+
+    # ordered by group in the order of counts, and every item drawn is in
+    # the group it was drawn for
+    assert len(pos) == 80
+    assert (GROUPS[pos[:50]] == "a").all()
+    assert (GROUPS[pos[50:]] == "c").all()
+    # items with zero weight are never drawn
+    assert (weights[pos] > 0).all()
+
+
+def test_grouped_weighted_sample_proportions():
+    weights = np.array([1, 1, 3, 1, 1, 0, 1, 4], dtype="float64")
+    counts = pd.Series([20000], index=["a"])
+
+    pos = sampling.grouped_weighted_sample(
+        GROUPS, weights, counts, rng=np.random.RandomState(1))
+
+    freq = np.bincount(pos, minlength=len(GROUPS)) / 20000.
+    np.testing.assert_allclose(freq, np.array([1, 0, 3, 0, 0, 0, 0, 4]) / 8.,
+                               atol=.02)
+
+
+def test_grouped_weighted_sample_errors():
+    weights = np.array([1, 0, 1, 1, 0, 1, 1, 1], dtype="float64")
+
+    # all of the items in b have zero weight
+    with pytest.raises(ValueError):
+        sampling.grouped_weighted_sample(
+            GROUPS, weights, pd.Series([1, 1], index=["a", "b"]))
+
+    # there are no items in d at all
+    with pytest.raises(ValueError):
+        sampling.grouped_weighted_sample(
+            GROUPS, weights, pd.Series([1], index=["d"]))
+
+
+def test_grouped_weighted_sample_reproducible():
+    weights = np.arange(1, 9, dtype="float64")
+    counts = pd.Series([10, 10, 10], index=["a", "b", "c"])
+
+    a = sampling.grouped_weighted_sample(
+        GROUPS, weights, counts, rng=np.random.RandomState(2))
+    b = sampling.grouped_weighted_sample(
+        GROUPS, weights, counts, rng=np.random.RandomState(2))
+
+    np.testing.assert_array_equal(a, b)
+
+
+def test_grouped_sample_without_replacement():
+    counts = pd.Series([3, 2], index=["a", "c"])
+
+    pos = sampling.grouped_sample(GROUPS, counts,
+                                  rng=np.random.RandomState(3))
+
+    assert len(pos) == 5
+    assert len(np.unique(pos)) == 5
+    assert (GROUPS[pos[:3]] == "a").all()
+    assert (GROUPS[pos[3:]] == "c").all()
+
+
+def test_grouped_sample_zero_weights():
+    weights = np.array([1, 1, 0, 1, 1, 2, 1, 0], dtype="float64")
+    counts = pd.Series([2, 2], index=["a", "b"])
+
+    for seed in range(20):
+        pos = sampling.grouped_sample(GROUPS, counts, weights=weights,
+                                      rng=np.random.RandomState(seed))
+        # a has exactly two items with positive weight, so those are the
+        # ones drawn every time
+        assert sorted(pos[:2]) == [0, 5]
+        assert sorted(pos[2:]) == [1, 4]
+
+
+def test_grouped_sample_too_many():
+    with pytest.raises(ValueError):
+        sampling.grouped_sample(GROUPS, pd.Series([3], index=["b"]))
+
+    # but with replacement that's fine
+    pos = sampling.grouped_sample(GROUPS, pd.Series([3], index=["b"]),
+                                  replace=True)
+    assert (GROUPS[pos] == "b").all()
+
+
+def test_grouped_sample_counts_without_replacement():
+    sizes = np.array([5, 0, 10, 2, 3, 1, 0, 4])
+    counts = pd.Series([15, 2, 1], index=["a", "b", "c"])
+
+    for seed in range(20):
+        drawn = sampling.grouped_sample_counts(
+            GROUPS, sizes, counts, rng=np.random.RandomState(seed))
+
+        # never more units than an item has, and every group's total
+        assert (drawn >= 0).all()
+        assert (drawn <= sizes).all()
+        totals = pd.Series(drawn).groupby(GROUPS).sum()
+        assert totals.to_dict() == {"a": 15, "b": 2, "c": 1}
+
+    # drawing every unit of a group takes all of them
+    drawn = sampling.grouped_sample_counts(
+        GROUPS, sizes, pd.Series([20], index=["a"]))
+    np.testing.assert_array_equal(drawn[GROUPS == "a"], [5, 10, 1, 4])
+    np.testing.assert_array_equal(drawn[GROUPS != "a"], 0)
+
+
+def test_grouped_sample_counts_hypergeometric():
+    sizes = np.array([5, 15, 0, 30])
+    rng = np.random.RandomState(4)
+
+    drawn = np.array([sampling.sample_counts(sizes, 10, rng=rng)
+                      for _ in range(4000)])
+
+    assert (drawn.sum(axis=1) == 10).all()
+    assert (drawn <= sizes).all()
+    np.testing.assert_allclose(drawn.mean(axis=0), [1, 3, 0, 6], atol=.1)
+
+
+def test_grouped_sample_counts_with_replacement():
+    weights = np.array([1, 0, 3, 0, 1, 0, 0, 0], dtype="float64")
+    counts = pd.Series([400, 7], index=["a", "b"])
+
+    drawn = sampling.grouped_sample_counts(
+        GROUPS, weights, counts, replace=True, rng=np.random.RandomState(5))
+
+    # units can be drawn more than once, but never from zero weight items
+    assert drawn[0] + drawn[2] == 400
+    assert drawn[4] == 7
+    np.testing.assert_array_equal(drawn[weights == 0], 0)
+
+
+def test_grouped_sample_counts_short():
+    sizes = np.array([5, 0, 10, 2, 3, 1, 0, 4])
+
+    with pytest.raises(ValueError):
+        sampling.grouped_sample_counts(GROUPS, sizes,
+                                       pd.Series([4], index=["b"]))
+
+    with pytest.raises(ValueError):
+        sampling.sample_counts([1, 2], 4)
+
+    with pytest.raises(ValueError):
+        sampling.sample_counts([0, 0], 1, replace=True)
+
+
+def test_sample_counts_zero_rows():
+    drawn = sampling.sample_counts(np.array([], dtype="int64"), 0)
+    assert len(drawn) == 0
+
+    np.testing.assert_array_equal(sampling.sample_counts([3, 4], 0), [0, 0])
+
+
+def test_grouped_sample_reproducible():
+    sizes = np.array([5, 1, 10, 2, 3, 1, 7, 4])
+    counts = pd.Series([12, 3, 4], index=["a", "b", "c"])
+
+    for replace in [False, True]:
+        a = sampling.grouped_sample(GROUPS, counts // 4, weights=sizes,
+                                    replace=replace,
+                                    rng=np.random.RandomState(6))
+        b = sampling.grouped_sample(GROUPS, counts // 4, weights=sizes,
+                                    replace=replace,
+                                    rng=np.random.RandomState(6))
+        np.testing.assert_array_equal(a, b)
+
+        a = sampling.grouped_sample_counts(GROUPS, sizes, counts,
+                                           replace=replace,
+                                           rng=np.random.RandomState(7))
+        b = sampling.grouped_sample_counts(GROUPS, sizes, counts,
+                                           replace=replace,
+                                           rng=np.random.RandomState(7))
+        np.testing.assert_array_equal(a, b)
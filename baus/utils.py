@@ -4,6 +4,8 @@ import orca
 import os
 from urbansim_defaults.utils import _remove_developed_buildings
 from urbansim.developer.developer import Developer as dev
+import sampling
+import balancing
 
 
 #####################
@@ -72,18 +74,14 @@ def groupby_random_choice(s, counts, replace=True):
     if counts.sum() == 0:
         return pd.Series()
 
-    return pd.concat([
-        s[s == grp].sample(cnt, replace=replace)
-        for grp, cnt in counts[counts > 0].iteritems()
-    ])
+    return s.iloc[sampling.grouped_sample(s.values, counts, replace=replace)]
 
 
-# pick random indexes from s without replacement
+# pick random indexes from s without replacement - s holds the number of
+# times each index can be picked (the indexes come back in index order)
 def random_indexes(s, num, replace=False):
-    return np.random.choice(
-        np.repeat(s.index.values, s.values),
-        num,
-        replace=replace)
+    return np.repeat(s.index.values,
+                     sampling.sample_counts(s.values, num, replace=replace))
 
 
 # This method takes a series of floating point numbers, rounds to
@@ -125,33 +123,19 @@ def scale_by_target(s, target, check_close=None):
 # this should be fairly self explanitory if you know ipf
 # seed_matrix is your best bet at the totals, col_marginals are
 # observed column marginals and row_marginals is the same for rows
+# (see balancing.ipf to balance more than two dimensions, or many
+# matrices at once)
 def simple_ipf(seed_matrix, col_marginals, row_marginals, tolerance=1, cnt=0):
     assert np.absolute(row_marginals.sum() - col_marginals.sum()) < 5.0
 
-    # first normalize on columns
-    ratios = col_marginals / seed_matrix.sum(axis=0)
-    seed_matrix *= ratios
-    closeness = np.absolute(row_marginals - seed_matrix.sum(axis=1)).sum()
-    assert np.absolute(col_marginals - seed_matrix.sum(axis=0)).sum() < .01
-    # print "row closeness", closeness
-    if closeness < tolerance:
-        return seed_matrix
-
-    # first normalize on rows
-    ratios = row_marginals / seed_matrix.sum(axis=1)
-    ratios[row_marginals == 0] = 0
-    seed_matrix = seed_matrix * ratios.reshape((ratios.size, 1))
-    assert np.absolute(row_marginals - seed_matrix.sum(axis=1)).sum() < .01
-    closeness = np.absolute(col_marginals - seed_matrix.sum(axis=0)).sum()
-    # print "col closeness", closeness
-    if closeness < tolerance:
-        return seed_matrix
-
-    if cnt >= 50:
-        return seed_matrix
-
-    return simple_ipf(seed_matrix, col_marginals, row_marginals,
-                      tolerance, cnt+1)
+    seed_matrix = np.asarray(seed_matrix, dtype="float64")
+
+    # first normalize on columns, then on rows
+    seed_matrix, _ = balancing.ipf(
+        seed_matrix, [((1,), col_marginals), ((0,), row_marginals)],
+        tolerance=tolerance, max_iterations=51 - cnt)
+
+    return seed_matrix
 
 """
 BELOW IS A SET OF UTITLIES TO COMPARE TWO SUMMARY DATAFRAMES, MAINLY LOOKING
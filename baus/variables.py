@@ -3,7 +3,10 @@ import pandas as pd
 from urbansim.utils import misc
 import orca
 import datasources
-from utils import nearest_neighbor, groupby_random_choice
+from utils import nearest_neighbor
+import sampling
+import network_cache
+from zoning import GROSS_AVE_UNIT_SIZE
 from urbansim_defaults import utils
 from urbansim_defaults import variables
 
@@ -246,11 +249,12 @@ def vacant_market_rate_units(buildings, households, settings, low_income):
     return s.reindex(buildings.index).fillna(0)
 
 
-@orca.column('buildings')
-def vacant_market_rate_units_minus_structural_vacancy(buildings,
-                                                      baseyear_taz_controls):
-    # this will take vacant_market_rate_units above and remove the number of
-    # units that we require to be vacant because of the structural vacancy rate
+# the number of units in each building which are kept vacant because of the
+# structural vacancy rate - this is cached for the step so the random draw
+# below happens once each time a model asks for it rather than every time
+# the column is read
+@orca.column('buildings', cache=True, cache_scope='step')
+def structural_vacancy_units(buildings, baseyear_taz_controls):
 
     # first sum the residential units by zone and multiply by structural
     # vacancy rate in order to get the required vacancies
@@ -261,35 +265,33 @@ def vacant_market_rate_units_minus_structural_vacancy(buildings,
         (residential_units_by_zone *
          baseyear_taz_controls.target_ltvacancy).astype("int")
 
-    # repeat building ids according to the number of vacant units
-    unit_zone_ids = \
-        buildings.zone_id.repeat(
-            buildings.vacant_market_rate_units.astype("int"))
+    vacant_units = buildings.vacant_market_rate_units.astype("int")
 
-    # this is some convoluted pandas for the next two lines!
-    # but the concept is simple:
     # can't require more vacancy units than we have
-    s = unit_zone_ids.value_counts().reindex(
+    s = vacant_units.groupby(buildings.zone_id).sum().reindex(
         required_vacant_units_by_zone.index).fillna(0)
 
     required_vacant_units_by_zone = \
         required_vacant_units_by_zone.clip(upper=s).astype('int')
 
-    # select among units to remove from the choice and leave vacant
-    remove_unit_zone_ids =\
-        groupby_random_choice(unit_zone_ids,
-                              required_vacant_units_by_zone,
-                              replace=False)
+    # select among units to remove from the choice and leave vacant - this
+    # draws units without replacement from each zone's buildings but only
+    # ever counts units by building, rather than making a row per unit
+    remove_units = sampling.grouped_sample_counts(
+        buildings.zone_id.values, vacant_units.values,
+        required_vacant_units_by_zone, replace=False)
 
-    # the building ids are the index, so count em up
-    remove_building_zone_ids = pd.Series(
-        remove_unit_zone_ids.index).value_counts()
+    return pd.Series(remove_units, index=buildings.index)
 
-    # subtract the ones we want to stay vacant from the vacant ones
-    s = buildings.vacant_market_rate_units.sub(
-        remove_building_zone_ids, fill_value=0)
 
-    return s
+# this isn't cached, so the vacancies it reports after the location choice
+# models place households include the households they placed
+@orca.column('buildings')
+def vacant_market_rate_units_minus_structural_vacancy(buildings):
+    # this will take vacant_market_rate_units above and remove the number of
+    # units that we require to be vacant because of the structural vacancy rate
+    return buildings.vacant_market_rate_units - \
+        buildings.structural_vacancy_units
 
 
 @orca.column('buildings', cache=True)
@@ -552,44 +554,27 @@ def residential_sales_price_sqft(parcel_sales_price_sqft_func):
 #############################
 
 
+# parcels x building types boolean matrices of the building types allowed
+# and dropped on each parcel, built once per run - this is the baseline
+# zoning, and in other scenarios the building types the scenario zoning adds
+# and drops and the juris retail eliminations are folded in, so checking a
+# form is an OR over the form's columns
+@orca.injectable('zoning_permissions', cache=True)
+def zoning_permissions(zoning_overlay, scenario):
+    return zoning_overlay.permissions(scenario)
+
+
 @orca.injectable('parcel_is_allowed_func', autocall=False)
 def parcel_is_allowed(form):
     settings = orca.get_injectable('settings')
     form_to_btype = settings["form_to_btype"]
     # we have zoning by building type but want
     # to know if specific forms are allowed
-    allowed = [orca.get_table('zoning_baseline')
-               ['type%d' % typ] > 0 for typ in form_to_btype[form]]
-
-    if orca.get_injectable("scenario") == "baseline":
-        return pd.concat(allowed, axis=1).max(axis=1).\
-            reindex(orca.get_table('parcels').index).fillna(False)
-
-    # also check if the scenario based zoning adds the building type
-    allowed2 = [orca.get_table('zoning_scenario')
-                ['add-type%d' % typ] > 0 for typ in form_to_btype[form]]
-
-    allowed = allowed + allowed2
-
-    allowed = pd.concat(allowed, axis=1).max(axis=1).\
-        reindex(orca.get_table('parcels').index).fillna(False)
-
-    # also check if the scenario based zoning drops the building type
+    permissions = orca.get_injectable('zoning_permissions')
+    btypes = form_to_btype[form]
     # NOTE THAT DROPPING OVERRIDES ADDING!
-    disallowed = [orca.get_table('zoning_scenario')
-                  ['drop-type%d' % typ] > 0 for typ in form_to_btype[form]]
-
-    disallowed = pd.concat(disallowed, axis=1).max(axis=1).\
-        reindex(orca.get_table('parcels').index).fillna(False)
-
-    allowed = allowed.astype('bool') & ~disallowed
-
-    settings = orca.get_injectable("settings")
-    if "eliminate_retail_zoning_from_juris" in settings and form == "retail":
-        allowed *= ~orca.get_table("parcels").juris.isin(
-            settings["eliminate_retail_zoning_from_juris"])
-
-    return allowed.astype("bool")
+    return permissions["allowed"][btypes].any(axis=1) & \
+        ~permissions["dropped"][btypes].any(axis=1)
 
 
 @orca.column('parcels', 'first_building_type_id')
@@ -1088,7 +1073,7 @@ def price_shifters(parcels, settings):
 
 @orca.column('parcels', 'node_id', cache=True)
 def node_id(parcels, net):
-    s = net["walk"].get_node_ids(parcels.x, parcels.y)
+    s = network_cache.node_ids(net["walk"], parcels.x, parcels.y)
     fill_val = s.value_counts().index[0]
     s = s.reindex(parcels.index).fillna(fill_val).astype('int')
     return s
@@ -1096,7 +1081,7 @@ def node_id(parcels, net):
 
 @orca.column('parcels', 'tmnode_id', cache=True)
 def node_id(parcels, net):
-    s = net["drive"].get_node_ids(parcels.x, parcels.y)
+    s = network_cache.node_ids(net["drive"], parcels.x, parcels.y)
     fill_val = s.value_counts().index[0]
     s = s.reindex(parcels.index).fillna(fill_val).astype('int')
     return s
@@ -1129,22 +1114,25 @@ def parcels_zoning_by_scenario(parcels, parcels_zoning_calculations,
     df["zoning_name"] = zoning_baseline["name"]
     df["zoning_source"] = zoning_baseline["tablename"]
 
-    for scenario in [str(i) for i in range(4)]:
+    scenarios = [str(i) for i in range(4)]
+    zoning_overlay = orca.get_injectable("zoning_overlay")
+    max_dua = zoning_overlay.effective_max_dua(scenarios)
+    max_far = zoning_overlay.effective_max_far(scenarios)
+
+    for scenario in scenarios:
+        df["max_dua_%s" % scenario] = max_dua[scenario]
+        df["max_far_%s" % scenario] = max_far[scenario]
+
         orca.clear_cache()
         orca.add_injectable("scenario", scenario)
+        orca.add_injectable("zoning_overlay", zoning_overlay)
         z = orca.get_table("parcels_zoning_calculations")
-        df["max_dua_%s" % scenario] = z.effective_max_dua
-        df["max_far_%s" % scenario] = z.effective_max_far
         df["du_underbuild_%s" % scenario] = z.zoned_du_underbuild
         df["non_res_cat_%s" % scenario] = z.non_res_categories
 
     return df
 
 
-GROSS_AVE_UNIT_SIZE = 1000.0
-PARCEL_USE_EFFICIENCY = .8
-HEIGHT_PER_STORY = 12.0
-
 ###################################
 #   Zoning Capacity Variables
 ###################################
@@ -1155,86 +1143,19 @@ def zoned_du(parcels, parcels_zoning_calculations):
     return parcels_zoning_calculations.effective_max_dua * parcels.parcel_acres
 
 
+# the baseline max dua (the least of the dua limit and the dua the far and
+# height limits allow) - in the other scenarios it's raised to the scenario
+# upzoning and lowered to the downzoning (so an upzoning never accidentally
+# downzones and vice versa), and is zero where residential isn't allowed
 @orca.column('parcels_zoning_calculations', 'effective_max_dua', cache=True)
-def effective_max_dua(zoning_baseline, parcels, scenario):
-
-    max_dua_from_far = zoning_baseline.max_far * 43560 / GROSS_AVE_UNIT_SIZE
-
-    max_far_from_height = (zoning_baseline.max_height / HEIGHT_PER_STORY) * \
-        PARCEL_USE_EFFICIENCY
-
-    max_dua_from_height = max_far_from_height * 43560 / GROSS_AVE_UNIT_SIZE
-
-    s = pd.concat([
-        zoning_baseline.max_dua,
-        max_dua_from_far,
-        max_dua_from_height
-    ], axis=1).min(axis=1)
-
-    if scenario == "baseline":
-        return s
-
-    # take the max dua IFF the upzone value is greater than the current value
-    # i.e. don't let the upzoning operation accidentally downzone
-
-    scenario_max_dua = orca.get_table("zoning_scenario").dua_up
-
-    s = pd.concat([
-        s,
-        scenario_max_dua
-    ], axis=1).max(axis=1)
-
-    # take the min dua IFF the upzone value is less than the current value
-    # i.e. don't let the downzoning operation accidentally upzone
-
-    scenario_min_dua = orca.get_table("zoning_scenario").dua_down
-
-    s = pd.concat([
-        s,
-        scenario_min_dua
-    ], axis=1).min(axis=1)
-
-    s3 = parcel_is_allowed('residential')
-
-    return (s.fillna(0) * s3).reindex(parcels.index).fillna(0).astype('float')
+def effective_max_dua(zoning_overlay, scenario):
+    return zoning_overlay.effective_max_dua([scenario])[scenario]
 
 
 @orca.column('parcels_zoning_calculations',
              'effective_max_far', cache=True)
-def effective_max_far(zoning_baseline, parcels, scenario):
-
-    max_far_from_height = (zoning_baseline.max_height / HEIGHT_PER_STORY) * \
-        PARCEL_USE_EFFICIENCY
-
-    s = pd.concat([
-        zoning_baseline.max_far,
-        max_far_from_height
-    ], axis=1).min(axis=1)
-
-    if scenario == "baseline":
-        return s
-
-    # take the max far IFF the upzone value is greater than the current value
-    # i.e. don't let the upzoning operation accidentally downzone
-
-    scenario_max_far = orca.get_table("zoning_scenario").far_up
-
-    s = pd.concat([
-        s,
-        scenario_max_far
-    ], axis=1).max(axis=1)
-
-    # take the max far IFF the downzone value is less than the current value
-    # i.e. don't let the downzoning operation accidentally upzone
-
-    scenario_min_far = orca.get_table("zoning_scenario").far_down
-
-    s = pd.concat([
-        s,
-        scenario_min_far
-    ], axis=1).min(axis=1)
-
-    return s.reindex(parcels.index).fillna(0).astype('float')
+def effective_max_far(zoning_overlay, scenario):
+    return zoning_overlay.effective_max_far([scenario])[scenario]
 
 
 @orca.column('parcels_zoning_calculations',
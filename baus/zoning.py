@@ -0,0 +1,243 @@
+import os
+import numpy as np
+import pandas as pd
+from urbansim.utils import misc
+
+
+# Scenario zoning used to be made by merging all of parcels_geography with
+# zoning_mods_N.csv and then taking row-wise mins and maxes of a handful of
+# concatenated series for every limit.  Only the parcels in a zoningmodcat
+# the scenario changes are different from the baseline though, so here the
+# baseline limits and permissions are arrays over the parcels and each
+# scenario is a sparse layer of overrides - the positions of the parcels it
+# changes and the zoning_mods row for each - which lets the effective limits
+# of any number of scenarios be computed at once.
+
+GROSS_AVE_UNIT_SIZE = 1000.0
+PARCEL_USE_EFFICIENCY = .8
+HEIGHT_PER_STORY = 12.0
+
+# the columns of the zoning_mods files which override the baseline limits
+LIMIT_COLUMNS = ["dua_up", "far_up", "dua_down", "far_down"]
+
+
+def baseline_max_far(zoning_baseline):
+    max_far_from_height = (zoning_baseline.max_height / HEIGHT_PER_STORY) * \
+        PARCEL_USE_EFFICIENCY
+
+    return np.fmin(zoning_baseline.max_far, max_far_from_height)
+
+
+def baseline_max_dua(zoning_baseline):
+    max_dua_from_far = zoning_baseline.max_far * 43560 / GROSS_AVE_UNIT_SIZE
+
+    max_far_from_height = (zoning_baseline.max_height / HEIGHT_PER_STORY) * \
+        PARCEL_USE_EFFICIENCY
+
+    max_dua_from_height = max_far_from_height * 43560 / GROSS_AVE_UNIT_SIZE
+
+    return np.fmin(np.fmin(zoning_baseline.max_dua, max_dua_from_far),
+                   max_dua_from_height)
+
+
+# the zoning_mods file of a scenario indexed by zoningmodcat, with the limit
+# overrides and a boolean add-typeN and drop-typeN column for every building
+# type in btype_map (which maps the codes in add_bldg and drop_bldg to
+# building type ids)
+def read_zoning_mods(scenario, btype_map):
+    df = pd.read_csv(os.path.join(misc.data_dir(),
+                                  'zoning_mods_%s.csv' % scenario),
+                     dtype={'jurisdiction': 'str'})
+
+    # merging the mods onto the parcels used to give a parcel one row for
+    # each row of its zoningmodcat - say so instead of duplicating parcels
+    dups = df.zoningmodcat[df.zoningmodcat.duplicated()].unique()
+    if len(dups):
+        print "WARNING: zoning_mods_%s.csv has more than one row for " \
+            "zoningmodcats %s - using the first row of each" % \
+            (scenario, ", ".join(map(str, dups)))
+    df = df.drop_duplicates("zoningmodcat").set_index("zoningmodcat")
+
+    mods = df[LIMIT_COLUMNS].astype("float64")
+    for k, v in btype_map.items():
+        mods['add-type%d' % v] = df.add_bldg.str.contains(k).\
+            fillna(False).astype("bool")
+        mods['drop-type%d' % v] = df.drop_bldg.astype(str).str.contains(k).\
+            fillna(False).astype("bool")
+
+    return mods
+
+
+class ZoningOverlay(object):
+    """
+    The baseline zoning of every parcel plus the zoning_mods of each
+    scenario as a sparse override layer (read the first time the scenario
+    is asked for).  All the "effective" methods take a list of scenarios and
+    return a DataFrame with a column for each, so scenarios can be compared
+    without switching the scenario injectable and clearing the cache.  The
+    "baseline" scenario has no zoning_mods and uses the baseline zoning
+    as is.
+
+    Parameters
+    ----------
+    index : Index
+        The parcel ids
+    zoningmodcat : Series
+        The zoningmodcat of each parcel
+    zoning_baseline : DataFrame
+        The baseline zoning, with max_dua, max_far, max_height and typeN
+        columns
+    juris : Series
+        The jurisdiction of each parcel
+    settings : dict
+        Uses building_type_map2, form_to_btype and
+        eliminate_retail_zoning_from_juris
+    """
+    def __init__(self, index, zoningmodcat, zoning_baseline, juris,
+                 settings):
+        self.index = index
+        self.zoningmodcat = zoningmodcat.reindex(index).values
+        self.btype_map = settings["building_type_map2"]
+        self.form_to_btype = settings["form_to_btype"]
+
+        zoning_baseline = zoning_baseline.reindex(index)
+        self.max_dua = baseline_max_dua(zoning_baseline).values
+        self.max_far = baseline_max_far(zoning_baseline).values
+
+        self.btypes = sorted(set(
+            typ for typ in self.btype_map.values()
+            if 'type%d' % typ in zoning_baseline.columns))
+        self.allowed = zoning_baseline[
+            ['type%d' % typ for typ in self.btypes]].values > 0
+
+        # retail zoning is eliminated in these jurisdictions in every
+        # scenario but the baseline
+        self.eliminated = juris.reindex(index).isin(
+            settings.get("eliminate_retail_zoning_from_juris", [])).values
+        self.retail = np.in1d(self.btypes, self.form_to_btype["retail"])
+
+        self.layers = {}
+
+    def layer(self, scenario):
+        """
+        The positions of the parcels the scenario's zoning_mods change, with
+        the limit overrides ("dua_up" etc) and the "add" and "drop" building
+        type matrices (over self.btypes) for each of those parcels.
+        """
+        if scenario not in self.layers:
+            mods = read_zoning_mods(scenario, self.btype_map)
+            pos = mods.index.get_indexer(self.zoningmodcat)
+            rows = np.flatnonzero(pos >= 0)
+            mods = mods.iloc[pos[rows]]
+
+            layer = {col: mods[col].values for col in LIMIT_COLUMNS}
+            layer["rows"] = rows
+            layer["add"] = mods[
+                ['add-type%d' % typ for typ in self.btypes]].values
+            layer["drop"] = mods[
+                ['drop-type%d' % typ for typ in self.btypes]].values
+            self.layers[scenario] = layer
+
+        return self.layers[scenario]
+
+    # the layers of the scenarios which aren't the baseline, with their
+    # positions in the scenario list
+    def _layers(self, scenarios):
+        return [(k, self.layer(scenario))
+                for k, scenario in enumerate(scenarios)
+                if scenario != "baseline"]
+
+    def _eliminate(self, allowed, cols, rows=slice(None)):
+        return allowed & ~(self.eliminated[rows][:, np.newaxis] &
+                           self.retail[cols][np.newaxis, :])
+
+    def permissions(self, scenario):
+        """
+        The building types allowed and dropped on each parcel in a scenario,
+        as a parcels x building types DataFrame of bools with "allowed" and
+        "dropped" at the top level of the columns.  A form is allowed where
+        any of its building types is allowed and none of them is dropped -
+        dropping overrides adding.
+        """
+        allowed = self.allowed.copy()
+        dropped = np.zeros(allowed.shape, dtype="bool")
+
+        if scenario != "baseline":
+            layer = self.layer(scenario)
+            rows = layer["rows"]
+            allowed[rows] |= layer["add"]
+            dropped[rows] = layer["drop"]
+            allowed = self._eliminate(allowed, np.arange(len(self.btypes)))
+
+        return pd.concat([
+            pd.DataFrame(allowed, index=self.index, columns=self.btypes),
+            pd.DataFrame(dropped, index=self.index, columns=self.btypes)
+        ], axis=1, keys=["allowed", "dropped"])
+
+    def effective_allowed(self, form, scenarios):
+        """
+        Whether a form is allowed on each parcel in each of the scenarios.
+        """
+        cols = [self.btypes.index(typ) for typ in self.form_to_btype[form]]
+        base = self.allowed[:, cols]
+
+        out = np.empty((len(scenarios), len(self.index)), dtype="bool")
+        out[:] = self._eliminate(base, cols).any(axis=1)
+        for k, scenario in enumerate(scenarios):
+            if scenario == "baseline":
+                out[k] = base.any(axis=1)
+
+        layers = self._layers(scenarios)
+        if layers:
+            flat = np.concatenate([
+                k * len(self.index) + layer["rows"] for k, layer in layers])
+            out.reshape(-1)[flat] = np.concatenate([
+                self._eliminate(base[layer["rows"]] | layer["add"][:, cols],
+                                cols, layer["rows"]).any(axis=1) &
+                ~layer["drop"][:, cols].any(axis=1)
+                for _, layer in layers])
+
+        return pd.DataFrame(out.T, index=self.index, columns=scenarios)
+
+    # the baseline limit, raised to the scenario's up value and then lowered
+    # to its down value where it has them - the parcels of every scenario
+    # are updated with a single fmax and fmin
+    def _limits(self, base, up, down, scenarios):
+        out = np.tile(base, (len(scenarios), 1))
+
+        layers = self._layers(scenarios)
+        if layers:
+            flat = np.concatenate([
+                k * len(self.index) + layer["rows"] for k, layer in layers])
+            ups = np.concatenate([layer[up] for _, layer in layers])
+            downs = np.concatenate([layer[down] for _, layer in layers])
+            out.reshape(-1)[flat] = np.fmin(
+                np.fmax(out.reshape(-1)[flat], ups), downs)
+
+            # missing limits are zero in the scenarios
+            ks = [k for k, _ in layers]
+            out[ks] = np.where(np.isnan(out[ks]), 0, out[ks])
+
+        return out
+
+    def effective_max_dua(self, scenarios):
+        """
+        The max dua of every parcel in each of the scenarios - zero where
+        residential isn't allowed (except in the baseline).
+        """
+        out = self._limits(self.max_dua, "dua_up", "dua_down", scenarios)
+
+        ks = [k for k, _ in self._layers(scenarios)]
+        if ks:
+            allowed = self.effective_allowed(
+                "residential", [scenarios[k] for k in ks]).values.T
+            out[ks] = out[ks] * allowed
+
+        return pd.DataFrame(out.T, index=self.index, columns=scenarios)
+
+    def effective_max_far(self, scenarios):
+        """
+        The max far of every parcel in each of the scenarios.
+        """
+        out = self._limits(self.max_far, "far_up", "far_down", scenarios)
+        return pd.DataFrame(out.T, index=self.index, columns=scenarios)
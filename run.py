@@ -1,6 +1,7 @@
 import os
 import sys
 import time
+import argparse
 import traceback
 from baus import models
 import pandas as pd
@@ -8,12 +9,14 @@ import orca
 import socket
 import warnings
 from baus.utils import compare_summary
+from baus.profiler import StepProfiler
+from baus import bake
+from baus.checkpoint import checkpoint_path, latest_checkpoint_run,\
+    restore_checkpoint
 from scripts.check_feedback import check_feedback
 
 warnings.filterwarnings("ignore")
 
-args = sys.argv[1:]
-
 SLACK = MAPS = "URBANSIM_SLACK" in os.environ
 LOGS = True
 INTERACT = False
@@ -35,17 +38,69 @@ LAST_KNOWN_GOOD_RUNS = {
     "5": 1059
 }
 
+parser = argparse.ArgumentParser(description='Run UrbanSim models.')
+
+parser.add_argument('-i', action='store_true', dest='interactive',
+                    help='enter interactive mode after loading data')
+
+parser.add_argument('-s', action='store', dest='scenario',
+                    help='specify which scenario to run')
+
+parser.add_argument('--run-number', action='store', dest='run_number',
+                    type=int, metavar='RUN',
+                    help='use this run number instead of taking the next ' +
+                    'one from the RUNNUM file')
+
+parser.add_argument('--resume-from', action='store', dest='resume_from',
+                    type=int, metavar='YEAR',
+                    help='restore the checkpoint saved after YEAR and ' +
+                    'continue the simulation from there')
+
+parser.add_argument('--resume-run', action='store', dest='resume_run',
+                    type=int, metavar='RUN',
+                    help='run number of the checkpoint to resume from ' +
+                    '(defaults to the latest run with a checkpoint for YEAR)')
+
+parser.add_argument('--bake', action='store_true', dest='bake',
+                    help='build the base year tables and save them to the ' +
+                    'base year snapshot')
+
+options = parser.parse_args()
+
+RESUME_FROM = options.resume_from
+
 orca.add_injectable("years_per_iter", EVERY_NTH_YEAR)
 
-if len(args) and args[0] == "-i":
+if options.bake:
+    MODE = "bake"
+    SLACK = MAPS = False
+
+if options.interactive:
     SLACK = MAPS = LOGS = False
     INTERACT = True
 
-if len(args) and args[0] == "-s":
-    orca.add_injectable("scenario", args[1])
+if RESUME_FROM:
+    # the other modes don't run the years a checkpoint is resumed into
+    if MODE != "simulation":
+        parser.error("--resume-from only works in the simulation mode")
+    if options.run_number is not None:
+        parser.error("--resume-from continues the run of the checkpoint - " +
+                     "use --resume-run instead of --run-number")
+
+if options.scenario:
+    orca.add_injectable("scenario", options.scenario)
+
+if options.run_number:
+    orca.add_injectable("run_number", options.run_number)
 
 SCENARIO = orca.get_injectable("scenario")
 
+if RESUME_FROM:
+    # a resumed run continues the run that saved the checkpoint, so that
+    # outputs from the earlier years stay next to the ones we write now
+    resume_run = options.resume_run or latest_checkpoint_run(RESUME_FROM)
+    orca.add_injectable("run_number", resume_run)
+
 if INTERACT:
     import code
     code.interact(local=locals())
@@ -56,7 +111,8 @@ run_num = orca.get_injectable("run_number")
 if LOGS:
     print '***The Standard stream is being written to /runs/run{0}.log***'\
         .format(run_num)
-    sys.stdout = sys.stderr = open("runs/run%d.log" % run_num, 'w')
+    sys.stdout = sys.stderr = open("runs/run%d.log" % run_num,
+                                   'a' if RESUME_FROM else 'w')
 
 if SLACK:
     from slacker import Slacker
@@ -103,7 +159,9 @@ def get_simulation_models(SCENARIO):
         "building_summary",
         "diagnostic_output",
         "geographic_summary",
-        "travel_model_output"
+        "travel_model_output",
+
+        "save_checkpoint"                # so we can resume from this year
     ]
 
     # calculate VMT taxes
@@ -138,6 +196,22 @@ def get_simulation_models(SCENARIO):
 
 def run_models(MODE, SCENARIO):
 
+    if MODE == "simulation" and RESUME_FROM:
+
+        # the checkpoint already has the corrected base year data
+        year = restore_checkpoint(checkpoint_path(run_num, RESUME_FROM))
+        years_to_run = range(year+EVERY_NTH_YEAR, OUT_YEAR+1, EVERY_NTH_YEAR)
+        models = get_simulation_models(SCENARIO)
+        orca.run(models, iter_vars=years_to_run)
+        return
+
+    if MODE == "bake":
+
+        # build the tables from scratch even if there's a snapshot already
+        bake.USE_SNAPSHOT = False
+        orca.run(["correct_baseyear_data", "bake_baseyear"])
+        return
+
     orca.run(["correct_baseyear_data"])
 
     if MODE == "simulation":
@@ -201,7 +275,7 @@ def run_models(MODE, SCENARIO):
 
         # the whole point of this is to get the feasibility dataframe
         # for debugging
-        df = orca.get_table("feasibility").to_frame()
+        df = orca.get_injectable("feasibility_store").to_frame()
         df = df.stack(level=0).reset_index(level=1, drop=True)
         df.to_csv("output/feasibility.csv")
 
@@ -214,6 +288,10 @@ print "Started", time.ctime()
 print "Current Commit : ", CURRENT_COMMIT.rstrip()
 print "Current Scenario : ", orca.get_injectable('scenario').rstrip()
 
+# record time and memory used by every step in every year
+profiler = StepProfiler()
+profiler.install()
+
 
 if SLACK:
     slack.chat.post_message(
@@ -236,8 +314,14 @@ except Exception as e:
         raise e
     sys.exit(0)
 
+finally:
+    profiler.write_csv("runs/run%d_step_profile.csv" % run_num,
+                       resumed_from=RESUME_FROM)
+
 print "Finished", time.ctime()
 
+print "Time spent by step:\n", profiler.summary()
+
 if MAPS:
 
     from urbansim_explorer import sim_explorer as se
@@ -0,0 +1,33 @@
+import sys
+import yaml
+import pandas as pd
+import orca
+sys.path.append(".")
+from baus import datasources
+from baus import variables
+from baus import subsidies
+from baus.feasibility import FeasibilityStore
+
+# screens a list of policies on the feasibility written by
+# python run.py with MODE = "feasibility" - the policies are a yaml list of
+# parameter sets (see subsidies.policy_sweep), e.g.
+#
+# - name: settings
+# - name: inclusionary_20
+#   inclusionary_pcts: .2
+# - name: high_vmt_fees
+#   res_for_res_fee_amounts: {VH: 50000, H: 30000, MH: 10000}
+#
+# python scripts/policy_sweep.py policies.yaml [scenario]
+#
+# the parameters which a policy doesn't give are the ones of the scenario
+
+policies = yaml.load(open(sys.argv[1]))
+if len(sys.argv) > 2:
+    orca.add_injectable("scenario", sys.argv[2])
+
+# the feasibility mode only runs feasibility for the residential form
+df = pd.read_csv("output/feasibility.csv", index_col="parcel_id")
+feasibility = FeasibilityStore.from_frames({"residential": df})
+subsidies.write_policy_sweep("output/policy_sweep.h5", feasibility,
+                             orca.get_table("parcels"), policies)
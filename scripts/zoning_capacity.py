@@ -0,0 +1,11 @@
+import sys
+sys.path.append(".")
+from baus import capacity
+
+# writes the zoned residential capacity (zoned_du, zoned_du_underbuild and
+# zoned_du_underbuild_nodev) of the baseline and every zoning_mods scenario
+# by parcel, jurisdiction and pda - pass scenarios to only compute those, e.g.
+# python scripts/zoning_capacity.py baseline 4
+
+capacity.write_zoning_capacity("output/zoning_capacity.h5",
+                               sys.argv[1:] or None)
@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import errno
+import runpy
+import socket
+import argparse
+import traceback
+import numpy as np
+
+# a long-lived model server - it loads the base year data once and then forks
+# a copy of itself for every scenario (or seed) that gets submitted, so a new
+# run starts simulating right away instead of spending minutes loading data.
+# The forked children share the base year tables with the server as
+# copy-on-write memory, and each child simply runs run.py, which finds
+# baus.models already imported and the base year tables already cached.
+#
+# start the server:
+#   python server.py serve &
+# submit runs to it:
+#   python server.py submit -s 4
+#   python server.py submit -s 4 --seed 1
+
+SOCKET = os.path.join("runs", "baus_server.sock")
+
+# these don't depend on the scenario so they are the same for every run
+WARM_TABLES = [
+    "parcels",
+    "parcels_geography",
+    "zoning_baseline",
+    "households",
+    "jobs",
+    "buildings"
+]
+
+
+def warm_up():
+    from baus import models
+    from baus import datasources
+    import orca
+
+    for name in WARM_TABLES:
+        print "Loading %s" % name
+        orca.get_table(name).local
+
+    print "Building networks"
+    orca.get_injectable("net")
+
+    # every child needs its own handle on the hdf5 store - hdf5 handles
+    # can't be shared between processes - so close the server's handle
+    # and let each child open the store again when it needs it
+    orca.get_injectable("store").close()
+    orca.add_injectable("store", datasources.hdfstore, cache=True)
+
+
+def reap_children():
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                return
+            raise
+        if pid == 0:
+            return
+        print "Run in process %d exited with status %d" % (pid, status >> 8)
+
+
+def run_child(request, run_num):
+    # seed each child separately - otherwise every child would continue the
+    # random stream the server had when it forked
+    np.random.seed(request.get("seed"))
+
+    sys.argv = ["run.py", "-s", str(request["scenario"]),
+                "--run-number", str(run_num)] + request.get("args", [])
+
+    try:
+        runpy.run_path("run.py", run_name="__main__")
+    except SystemExit as e:
+        return e.code or 0
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+# run.py points stdout and stderr at a buffered runs/runN.log, and os._exit
+# doesn't flush anything, so flush and close them first or the end of the
+# log is lost
+def exit_child(code):
+    for f in [sys.stdout, sys.stderr]:
+        try:
+            f.flush()
+            f.close()
+        except Exception:
+            pass
+    os._exit(code)
+
+
+def serve(socket_name):
+    from urbansim.utils import misc
+
+    warm_up()
+
+    if os.path.exists(socket_name):
+        os.remove(socket_name)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_name)
+    server.listen(5)
+    server.settimeout(5)
+
+    print "Listening for runs on %s" % socket_name
+    sys.stdout.flush()
+
+    while True:
+        reap_children()
+
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+
+        conn.settimeout(None)
+        request = json.loads(conn.makefile().readline())
+
+        # hand out run numbers here so children don't race on RUNNUM
+        run_num = misc.get_run_number()
+
+        pid = os.fork()
+        if pid == 0:
+            server.close()
+            conn.close()
+            code = 1
+            try:
+                code = run_child(request, run_num)
+            finally:
+                exit_child(code)
+
+        conn.sendall(json.dumps({"run_number": run_num, "pid": pid}) + "\n")
+        conn.close()
+
+        print "Started run %d (scenario %s) in process %d" % \
+            (run_num, request["scenario"], pid)
+        sys.stdout.flush()
+
+
+def submit(socket_name, scenario, seed, args):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(socket_name)
+    conn.sendall(json.dumps({
+        "scenario": scenario,
+        "seed": seed,
+        "args": args
+    }) + "\n")
+    reply = json.loads(conn.makefile().readline())
+    conn.close()
+    print "Started run %d for scenario %s" % (reply["run_number"], scenario)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Keep the base year data loaded between runs.')
+    parser.add_argument('--socket', action='store', default=SOCKET,
+                        help='unix socket the server listens on')
+    subparsers = parser.add_subparsers(dest='command')
+
+    subparsers.add_parser('serve', help='load the data and wait for runs')
+
+    p = subparsers.add_parser('submit', help='start a run on the server')
+    p.add_argument('-s', action='store', dest='scenario', required=True,
+                   help='specify which scenario to run')
+    p.add_argument('--seed', action='store', type=int,
+                   help='seed for the random number generator of the run')
+    p.add_argument('args', nargs=argparse.REMAINDER,
+                   help='any other arguments are passed on to run.py')
+
+    options = parser.parse_args()
+
+    if options.command == "serve":
+        serve(options.socket)
+    else:
+        submit(options.socket, options.scenario, options.seed, options.args)